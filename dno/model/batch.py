@@ -0,0 +1,297 @@
+"""
+Batched localization of many trajectories on the same map.
+"""
+from typing import Optional, Tuple, List, Sequence
+
+import numpy as np
+from loguru import logger
+
+from dno.model import scoring
+from dno.proto.data import Map, Solution, TaskBatch, TASK_COLUMNS
+from dno.proto.trace import TRACER, traced
+
+# candidates advanced in a single pass of the filter
+FILTER_CHUNK_SIZE = 1 << 16
+
+
+class BatchModel:
+    """
+    Same algorithm as `Model` in the candidate list mode, run for `size` trajectories at once.
+    Candidates of all trajectories are kept in one struct of arrays tagged with the owner trajectory,
+    candidates of every trajectory form a contiguous run, so filtering is a single pass over the whole batch.
+    Trajectories measuring equal heights share the height index lookups and the pyramid tile masks,
+    dead reckoning is vectorized over the whole batch.
+    There is no time limit and no deferred work: seeds over `max_candidates` are truncated.
+    """
+
+    def __init__(self, map_raw: Map, size: int, c: int=400, max_candidates: Optional[int]=2_000_000):
+        self.map: Map = map_raw
+        self.map_arr: np.ndarray = map_raw.data
+        self.n: int = map_raw.data.shape[0]
+        self._flat_map: np.ndarray = np.ascontiguousarray(map_raw.data).ravel()
+        self.size = size
+        self.c = c
+        self.max_candidates = max_candidates
+        # candidates of all trajectories: owner trajectory, map row, map column
+        self.owners: np.ndarray = np.empty(0, dtype=np.int32)
+        self.xs: np.ndarray = np.empty(0, dtype=np.int32)
+        self.ys: np.ndarray = np.empty(0, dtype=np.int32)
+        self._counts: np.ndarray = np.zeros(size, dtype=np.int64)
+        # trajectories in the order of their runs of candidates
+        self._run_owners: np.ndarray = np.empty(0, dtype=np.int32)
+        # per trajectory state
+        self.ready: np.ndarray = np.zeros(size, dtype=bool)
+        self.coords_x: np.ndarray = np.zeros(size, dtype=np.float64)
+        self.coords_y: np.ndarray = np.zeros(size, dtype=np.float64)
+        self.last_speed: np.ndarray = np.full(size, np.nan)
+
+    def counts(self) -> np.ndarray:
+        """
+        Number of candidates of every trajectory.
+        """
+        return self._counts
+
+    def _set_candidates(self, owners: np.ndarray, xs: np.ndarray, ys: np.ndarray, run_owners: np.ndarray,
+                        counts: np.ndarray):
+        self.owners, self.xs, self.ys = owners, xs, ys
+        self._counts = counts
+        self._run_owners = run_owners[counts[run_owners] > 0]
+
+    def release(self, owners: np.ndarray):
+        """
+        Drop candidates of finished trajectories.
+        """
+        if not self._counts[owners].any():
+            return
+        released = np.zeros(self.size, dtype=bool)
+        released[owners] = True
+        run_owners, _, lengths = self.runs()
+        kept = np.repeat(~released[run_owners], lengths)
+        counts = self._counts.copy()
+        counts[released] = 0
+        self._set_candidates(self.owners[kept], self.xs[kept], self.ys[kept], run_owners, counts)
+
+    def handle_tasks(self, tasks: TaskBatch, owners: Optional[np.ndarray]=None) -> Tuple[np.ndarray, ...]:
+        """
+        Advance trajectories by one step.
+        :param tasks:  Next task of every advanced trajectory.
+        :param owners: Trajectory of every task row, all trajectories in order by default.
+        :return:       Solution columns x, y and ready aligned with the task rows.
+        """
+        owners = np.arange(self.size) if owners is None else np.asarray(owners)
+        was_ready = self.ready[owners]
+        counts = self._counts[owners]
+        filtering = ~was_ready & (counts > 0)
+        seeding = ~was_ready & (counts == 0)
+        if filtering.any():
+            self._filter(owners[filtering], tasks.height[filtering], tasks.vx[filtering], tasks.vy[filtering])
+        if seeding.any():
+            self._seed(owners[seeding], tasks.height[seeding])
+        moving = ~was_ready & (tasks.speed != 0)
+        self.last_speed[owners[moving]] = tasks.speed[moving]
+        self._lock(owners[~was_ready])
+        if was_ready.any():
+            self._dead_reckon(owners[was_ready], tasks.speed[was_ready], tasks.psi[was_ready])
+        TRACER.gauge('batch.candidates', len(self.owners))
+        return self.coords_x[owners], self.coords_y[owners], self.ready[owners]
+
+    def solutions(self, tasks: TaskBatch, owners: Optional[np.ndarray]=None) -> List[Solution]:
+        """
+        Same as `handle_tasks`, but returns Solution objects.
+        """
+        xs, ys, ready = self.handle_tasks(tasks, owners)
+        return [Solution(x=x, y=y, ready=r) if r else Solution(ready=False)
+                for x, y, r in zip(xs.tolist(), ys.tolist(), ready.tolist())]
+
+    @traced('batch.seed')
+    def _seed(self, owners: np.ndarray, heights: np.ndarray):
+        seeds = {}
+        parts_owners, parts_xs, parts_ys = [self.owners], [self.xs], [self.ys]
+        counts = self._counts.copy()
+        for owner, height in zip(owners.tolist(), heights.tolist()):
+            if height not in seeds:
+                rows, cols = self.map.height_index.query(height, self.c, by_distance=True)
+                if self.max_candidates is not None and len(rows) > self.max_candidates:
+                    logger.warning(f"[candidates: {len(rows)}] Truncating since "
+                                   f"number of candidates > max ({self.max_candidates})...")
+                    rows, cols = rows[:self.max_candidates], cols[:self.max_candidates]
+                seeds[height] = rows.astype(np.int32), cols.astype(np.int32)
+            rows, cols = seeds[height]
+            parts_owners.append(np.full(len(rows), owner, dtype=np.int32))
+            parts_xs.append(rows)
+            parts_ys.append(cols)
+            counts[owner] = len(rows)
+        self._set_candidates(*(np.concatenate(parts) for parts in (parts_owners, parts_xs, parts_ys)),
+                             np.concatenate((self._run_owners, owners.astype(np.int32))), counts)
+
+    def runs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Candidates of every trajectory are stored contiguously, in the order of `_run_owners`.
+        :return: Owner, start and length of every run of candidates.
+        """
+        lengths = self._counts[self._run_owners]
+        return self._run_owners, np.cumsum(lengths) - lengths, lengths
+
+    @traced('batch.filter')
+    def _filter(self, owners: np.ndarray, heights: np.ndarray, vxs: np.ndarray, vys: np.ndarray):
+        pyramid = self.map.pyramid
+        # tile masks are built once per distinct height and stacked for a single flat lookup
+        distinct, mask_ids = np.unique(heights, return_inverse=True)
+        tile_masks = np.concatenate([pyramid.tile_mask(height - self.c, height + self.c).ravel()
+                                     for height in distinct.tolist()])
+        # per trajectory step tables
+        active = np.zeros(self.size, dtype=bool)
+        active[owners] = True
+        step_xs, step_ys = np.zeros(self.size, dtype=np.int32), np.zeros(self.size, dtype=np.int32)
+        step_xs[owners], step_ys[owners] = np.round(vxs), np.round(vys)
+        step_heights = np.zeros(self.size, dtype=np.int64)
+        step_heights[owners] = heights
+        mask_offsets = np.zeros(self.size, dtype=np.int32)
+        mask_offsets[owners] = mask_ids.ravel() * pyramid.mins[0].size
+        steps = step_xs, step_ys, step_heights, mask_offsets
+        # candidates of trajectories not advanced by this step are kept as is
+        run_owners, starts, lengths = self.runs()
+        moved = active[run_owners]
+        if moved.all():
+            kept = None
+            xs, ys = self.xs, self.ys
+        else:
+            kept = ~np.repeat(moved, lengths)
+            xs, ys = self.xs[~kept], self.ys[~kept]
+            run_owners, starts, lengths = run_owners[moved], starts[moved], lengths[moved]
+        # runs are cut into chunks filtered one by one: temporaries of the whole batch would spill out of the caches
+        # and every pass would page in freshly mapped memory
+        bounds = np.cumsum(lengths)
+        piece_bounds = np.union1d(bounds, np.arange(FILTER_CHUNK_SIZE, bounds[-1], FILTER_CHUNK_SIZE))
+        piece_runs = np.searchsorted(bounds, piece_bounds)
+        piece_lengths = np.diff(piece_bounds, prepend=0)
+        chunk_bounds = np.searchsorted(piece_bounds, np.arange(0, bounds[-1], FILTER_CHUNK_SIZE), side='right')
+        parts_xs, parts_ys, parts_lengths = [], [], []
+        for start, first, last in zip(range(0, int(bounds[-1]), FILTER_CHUNK_SIZE), chunk_bounds.tolist(),
+                                      np.append(chunk_bounds[1:], len(piece_bounds)).tolist()):
+            stop = start + FILTER_CHUNK_SIZE
+            next_xs, next_ys, next_lengths = self._filter_runs(xs[start:stop], ys[start:stop],
+                                                               run_owners[piece_runs[first:last]],
+                                                               piece_lengths[first:last], steps, tile_masks)
+            parts_xs.append(next_xs)
+            parts_ys.append(next_ys)
+            parts_lengths.append(next_lengths)
+        # pieces of a run are consecutive
+        lengths = np.add.reduceat(np.concatenate(parts_lengths),
+                                  np.searchsorted(piece_runs, np.arange(len(run_owners))))
+        parts_owners = [np.repeat(run_owners, lengths)]
+        lost = lengths == 0
+        if lost.any():
+            for owner in run_owners[lost].tolist():
+                logger.warning(f"[trajectory: {owner}] No new candidates selected, selecting first from first...")
+            parts_owners.append(run_owners[lost])
+            parts_xs.append(self.xs[starts[lost]])
+            parts_ys.append(self.ys[starts[lost]])
+            lengths[lost] = 1
+        if kept is not None:
+            parts_owners.append(self.owners[kept])
+            parts_xs.append(self.xs[kept])
+            parts_ys.append(self.ys[kept])
+        counts = self._counts.copy()
+        counts[run_owners] = lengths
+        # lost trajectories and the kept ones are appended after the filtered runs
+        parts_runs = [run_owners[~lost], run_owners[lost]]
+        if kept is not None:
+            parts_runs.append(self._run_owners[~moved])
+        self._set_candidates(*(parts[0] if len(parts) == 1 else np.concatenate(parts)
+                               for parts in (parts_owners, parts_xs, parts_ys)),
+                             np.concatenate(parts_runs), counts)
+
+    def _filter_runs(self, xs: np.ndarray, ys: np.ndarray, run_owners: np.ndarray, lengths: np.ndarray,
+                     steps: Tuple[np.ndarray, ...], tile_masks: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        Advance consecutive runs of candidates in a single pass.
+        :param steps:      Per trajectory tables of the x and y steps, the heights and the tile mask offsets.
+        :param tile_masks: Stacked flat tile masks.
+        :return:           Advanced candidates and the new run lengths.
+        """
+        n_rows, n_cols = self.map_arr.shape
+        pyramid = self.map.pyramid
+        n_tile_cols = pyramid.mins[0].shape[1]
+        step_xs, step_ys, step_heights, mask_offsets = steps
+        # step columns are repeated over the runs and the runs are recounted after every selection,
+        # which is much cheaper than gathering by the owner and selecting from the owner column
+        next_xs = xs + np.repeat(step_xs[run_owners], lengths)
+        next_ys = ys + np.repeat(step_ys[run_owners], lengths)
+        # negative coordinates wrap around to large unsigned ones, so a single comparison per axis is enough
+        inside = (next_xs.view(np.uint32) < n_rows) & (next_ys.view(np.uint32) < n_cols)
+        # flat lookups are about twice as fast as indexing by (row, column) pairs,
+        # tiles of the candidates outside the map are clipped into range and rejected by `inside`
+        tiles = next_xs // pyramid.tile
+        tiles *= n_tile_cols
+        tiles += next_ys // pyramid.tile
+        tiles += np.repeat(mask_offsets[run_owners], lengths)
+        passed = inside & tile_masks.take(tiles, mode='clip')
+        selected = np.flatnonzero(passed)
+        next_xs, next_ys, lengths = next_xs[selected], next_ys[selected], run_lengths(selected, lengths)
+        cells = next_xs * n_cols
+        cells += next_ys
+        delta = np.repeat(step_heights[run_owners], lengths) - self._flat_map[cells]
+        matched = (delta > -self.c) & (delta < self.c)
+        selected = np.flatnonzero(matched)
+        return next_xs[selected], next_ys[selected], run_lengths(selected, lengths)
+
+    def _lock(self, owners: np.ndarray):
+        """
+        Mark trajectories of `owners` with a single candidate as ready and drop their candidates.
+        """
+        single = np.zeros(self.size, dtype=bool)
+        single[owners] = self._counts[owners] == 1
+        if not single.any():
+            return
+        run_owners, _, lengths = self.runs()
+        locked = np.repeat(single[run_owners], lengths)
+        locked_owners = self.owners[locked]
+        # candidates are (row, column), coordinates are (x, y) = (column, row)
+        self.coords_x[locked_owners] = self.ys[locked]
+        self.coords_y[locked_owners] = self.xs[locked]
+        self.ready[locked_owners] = True
+        counts = self._counts.copy()
+        counts[locked_owners] = 0
+        self._set_candidates(self.owners[~locked], self.xs[~locked], self.ys[~locked], run_owners, counts)
+
+    def _dead_reckon(self, owners: np.ndarray, speeds: np.ndarray, psi: np.ndarray):
+        speeds = np.where(speeds == 0, np.nan_to_num(self.last_speed[owners]), speeds)
+        angles = np.deg2rad(psi)
+        new_x = self.coords_x[owners] + speeds * np.sin(angles)
+        new_y = self.coords_y[owners] + speeds * np.cos(angles)
+        # same wrapping as Model.bound_coordinates
+        for new in (new_x, new_y):
+            new[new < 0] += self.n / 2
+            new[new > self.n] -= self.n / 2
+        self.coords_x[owners] = np.maximum(0, new_x)
+        self.coords_y[owners] = np.maximum(0, new_y)
+        self.last_speed[owners] = speeds
+
+
+def run_lengths(selected: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Lengths of the runs after the selection.
+    :param selected: Sorted positions of the selected values.
+    :param lengths:  Lengths of the consecutive runs before the selection.
+    """
+    return np.diff(np.searchsorted(selected, np.cumsum(lengths)), prepend=0)
+
+
+def replay_batch(land_map: Map, trajectories: Sequence[TaskBatch], **kwargs) -> np.ndarray:
+    """
+    Localize all recorded trajectories on the map together.
+    :param kwargs: BatchModel parameters.
+    :return:       MSE of every trajectory.
+    """
+    model = BatchModel(land_map, size=len(trajectories), **kwargs)
+    lengths = np.array([len(trajectory) for trajectory in trajectories])
+    total_errors = np.zeros(len(trajectories), dtype=np.float64)
+    for step in range(int(lengths.max(initial=0))):
+        owners = np.flatnonzero(lengths > step)
+        tasks = TaskBatch.from_columns({column: [getattr(trajectories[owner], column)[step] for owner in owners]
+                                        for column in TASK_COLUMNS})
+        xs, ys, ready = model.handle_tasks(tasks, owners)
+        total_errors[owners] += scoring.step_errors(xs, ys, ready, tasks.x, tasks.y, land_map.data.size)
+        model.release(np.flatnonzero(lengths == step + 1))
+    return total_errors / np.maximum(lengths, 1)
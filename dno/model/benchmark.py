@@ -0,0 +1,176 @@
+"""
+Per-step latency benchmark: replays recorded tasks through the localization engines
+and records latency percentiles and candidate counts per step phase.
+Peak memory is opt-in and measured in a separate pass, since tracing allocations slows down every step.
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import defaultdict
+from typing import Type, Sequence, Optional, Dict, List
+
+import numpy as np
+from loguru import logger
+
+from dno.model.model import Model
+from dno.model.replay import MODELS
+from dno.proto import utils
+from dno.proto.columnar import open_session
+
+PERCENTILES = (50, 95, 99)
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(utils.get_project_root()),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_task(model_class: Type[Model], task_num: int, trace_memory: bool=False) -> Dict[str, List[dict]]:
+    """
+    Replay a single task measuring every step.
+    :return: Step measurements grouped by phase.
+    """
+    reader = open_session(utils.get_session_path(task_num))
+    land_map = reader.read_map()
+    model = model_class(land_map)
+    steps = defaultdict(list)
+    for task in reader.iter_tasks():
+        phase = model.phase
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        model.handle_task(task)
+        elapsed = time.perf_counter() - start
+        step = {"seconds": elapsed}
+        if trace_memory:
+            step["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        candidates = getattr(model, 'candidates', None)
+        if candidates is not None:
+            step["candidates"] = len(candidates)
+        steps[phase].append(step)
+    return steps
+
+
+def summarize(steps: List[dict], time_limit: Optional[float]) -> dict:
+    seconds = np.array([step["seconds"] for step in steps])
+    summary = {
+        "steps": len(steps),
+        **{f"p{percentile}_ms": float(np.percentile(seconds, percentile) * 1000) for percentile in PERCENTILES},
+        "max_ms": float(seconds.max() * 1000),
+        "mean_ms": float(seconds.mean() * 1000),
+    }
+    if time_limit is not None:
+        summary["over_time_limit"] = int((seconds >= time_limit).sum())
+    if "candidates" in steps[0]:
+        candidates = np.array([step["candidates"] for step in steps])
+        summary["candidates_median"] = float(np.median(candidates))
+        summary["candidates_max"] = int(candidates.max())
+    return summary
+
+
+def measure_memory(model_class: Type[Model], task_nums: Sequence[int]) -> Dict[str, int]:
+    """
+    Replay the tasks once more with allocation tracing.
+    :return: Peak traced memory of every phase.
+    """
+    peaks = defaultdict(int)
+    tracemalloc.start()
+    try:
+        for task_num in task_nums:
+            for phase, steps in benchmark_task(model_class, task_num, trace_memory=True).items():
+                peaks[phase] = max(peaks[phase], max(step["peak_memory"] for step in steps))
+    finally:
+        tracemalloc.stop()
+    return dict(peaks)
+
+
+def run_benchmark(task_nums: Sequence[int], model_names: Sequence[str], trace_memory: bool=False,
+                  time_limit: Optional[float]=1.8) -> dict:
+    """
+    Benchmark every engine on every task.
+    :param trace_memory: Add peak memory of every phase, measured in a separate pass after the timed one.
+    :return:             Machine-readable results.
+    """
+    results = {
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "tasks": list(task_nums),
+        "time_limit": time_limit,
+        "models": {},
+    }
+    for model_name in model_names:
+        phases = defaultdict(list)
+        for task_num in task_nums:
+            logger.info(f"Benchmarking {model_name} on task {task_num}...")
+            for phase, steps in benchmark_task(MODELS[model_name], task_num).items():
+                phases[phase].extend(steps)
+        summaries = {phase: summarize(steps, time_limit) for phase, steps in phases.items()}
+        if trace_memory:
+            logger.info(f"Measuring memory of {model_name}...")
+            for phase, peak in measure_memory(MODELS[model_name], task_nums).items():
+                if phase in summaries:
+                    summaries[phase]["peak_memory"] = peak
+        results["models"][model_name] = summaries
+    return results
+
+
+def compare(baseline: dict, current: dict, metric: str="p95_ms", threshold: float=1.2) -> List[str]:
+    """
+    Find phases whose metric grew more than `threshold` times against the baseline.
+    :return: Descriptions of regressions.
+    """
+    regressions = []
+    for model_name, phases in current["models"].items():
+        for phase, summary in phases.items():
+            base = baseline.get("models", {}).get(model_name, {}).get(phase)
+            if base is None or metric not in base or base[metric] <= 0:
+                continue
+            ratio = summary[metric] / base[metric]
+            if ratio > threshold:
+                regressions.append(f"{model_name}/{phase}: {metric} {base[metric]:.2f} -> "
+                                   f"{summary[metric]:.2f} (x{ratio:.2f})")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("task_nums", type=int, nargs='+', metavar="task_nums",
+                        help="task numbers to replay, -1 for all tasks")
+    parser.add_argument("--models", type=str, nargs='+', choices=list(MODELS), default=list(MODELS),
+                        help="localization engines to benchmark")
+    parser.add_argument("--output", type=str, default='bench.json', help="path to write JSON results to")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="allowed p95 slowdown against the baseline")
+    parser.add_argument("--memory", action='store_true',
+                        help="measure peak memory in an extra traced pass, latencies are never traced")
+    args = parser.parse_args()
+    if len(args.task_nums) == 1 and args.task_nums[0] == -1:
+        args.task_nums = list(range(1, 32))
+    logger.disable('dno.model')
+    logger.disable('dno.proto')
+    results = run_benchmark(args.task_nums, args.models, trace_memory=args.memory)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    for model_name, phases in results["models"].items():
+        for phase, summary in phases.items():
+            logger.success(f"{model_name}/{phase}: {summary}")
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(json.load(file), results, threshold=args.threshold)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
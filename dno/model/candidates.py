@@ -0,0 +1,305 @@
+"""
+Candidate positions storage for the localization model.
+"""
+from abc import abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Tuple, List, Deque, Optional, Iterator, Sequence, Union
+
+import numpy as np
+from loguru import logger
+
+from dno.proto.data import Map
+
+
+# displacement along one axis: a single value or a tuple of hypotheses
+Motion = Union[int, Tuple[int, ...]]
+
+
+class BaseCandidates:
+    """
+    Set of candidate positions tracked by the model.
+    """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def __getitem__(self, item: int) -> Tuple[int, int]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def head(self, size: int) -> 'BaseCandidates':
+        """
+        First `size` candidates as a new set.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def filter_by_task(self, land_map: Map, vx: int, vy: int, height: int, c: int) -> 'BaseCandidates':
+        """
+        Shift all candidates by (vx, vy) and keep those inside the map with height within (-c, c) of `height`.
+        :param land_map: Heights map.
+        :param vx:      Shift of the first coordinate.
+        :param vy:      Shift of the second coordinate.
+        :param height:  Measured height.
+        :param c:       Height tolerance (exclusive).
+        :return:        Filtered candidates.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def filter_by_hypotheses(self, land_map: Map, vxs: Tuple[int, ...], vys: Tuple[int, ...], height: int,
+                             c: int) -> 'BaseCandidates':
+        """
+        Same as `filter_by_task`, but every candidate tries all (vxs[i], vys[i]) displacement hypotheses
+        and moves along the one with the closest height.
+        """
+        raise NotImplementedError()
+
+
+def advance(candidates: BaseCandidates, land_map: Map, vx: Motion, vy: Motion, height: int, c: int) -> BaseCandidates:
+    """
+    Filter candidates by a single displacement or by the best of several displacement hypotheses.
+    """
+    if isinstance(vx, tuple):
+        return candidates.filter_by_hypotheses(land_map, vx, vy, height, c)
+    return candidates.filter_by_task(land_map, vx, vy, height, c)
+
+
+@dataclass
+class CandidateSet(BaseCandidates):
+    """
+    Compact candidate store: two int32 coordinate columns.
+    First column indexes the map rows, second one - the map columns.
+    """
+    xs: np.ndarray
+    ys: np.ndarray
+
+    @classmethod
+    def from_coords(cls, xs: np.ndarray, ys: np.ndarray) -> 'CandidateSet':
+        return cls(xs=np.asarray(xs, dtype=np.int32), ys=np.asarray(ys, dtype=np.int32))
+
+    @classmethod
+    def empty(cls) -> 'CandidateSet':
+        return cls.from_coords(np.empty(0), np.empty(0))
+
+    @classmethod
+    def concat(cls, sets: Sequence['CandidateSet']) -> 'CandidateSet':
+        if not sets:
+            return cls.empty()
+        return cls(xs=np.concatenate([s.xs for s in sets]), ys=np.concatenate([s.ys for s in sets]))
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    def __getitem__(self, item: int) -> Tuple[int, int]:
+        return int(self.xs[item]), int(self.ys[item])
+
+    def head(self, size: int) -> 'CandidateSet':
+        return CandidateSet(xs=self.xs[:size], ys=self.ys[:size])
+
+    def tail(self, start: int) -> 'CandidateSet':
+        """
+        Candidates starting from `start` as a new set.
+        """
+        return CandidateSet(xs=self.xs[start:], ys=self.ys[start:])
+
+    def chunks(self, size: int) -> Iterator['CandidateSet']:
+        """
+        Split into consecutive sets of at most `size` candidates.
+        """
+        for start in range(0, len(self), size):
+            yield CandidateSet(xs=self.xs[start:start + size], ys=self.ys[start:start + size])
+
+    def shift(self, land_map: Map, vx: int, vy: int) -> 'ShiftedSet':
+        """
+        Shift all candidates by (vx, vy) dropping those leaving the map and look up their heights,
+        `filter_by_task` result is then left to the height check.
+        """
+        n_rows, n_cols = land_map.data.shape
+        next_xs = self.xs + np.int32(vx)
+        next_ys = self.ys + np.int32(vy)
+        inside = (next_xs >= 0) & (next_xs < n_rows) & (next_ys >= 0) & (next_ys < n_cols)
+        next_xs, next_ys = next_xs[inside], next_ys[inside]
+        return ShiftedSet(xs=next_xs, ys=next_ys, heights=land_map.data[next_xs, next_ys])
+
+    def filter_by_task(self, land_map: Map, vx: int, vy: int, height: int, c: int) -> 'CandidateSet':
+        n_rows, n_cols = land_map.data.shape
+        next_xs = self.xs + np.int32(vx)
+        next_ys = self.ys + np.int32(vy)
+        inside = (next_xs >= 0) & (next_xs < n_rows) & (next_ys >= 0) & (next_ys < n_cols)
+        next_xs, next_ys = next_xs[inside], next_ys[inside]
+        # typed scalar keeps the difference in int64 whatever the map dtype is
+        delta = np.int64(height) - land_map.data[next_xs, next_ys]
+        matched = (delta > -c) & (delta < c)
+        return CandidateSet(xs=next_xs[matched], ys=next_ys[matched])
+
+    def filter_by_hypotheses(self, land_map: Map, vxs: Tuple[int, ...], vys: Tuple[int, ...], height: int,
+                             c: int) -> 'CandidateSet':
+        n_rows, n_cols = land_map.data.shape
+        # (candidates, hypotheses) grids of positions
+        next_xs = self.xs[:, None] + np.asarray(vxs, dtype=np.int32)[None, :]
+        next_ys = self.ys[:, None] + np.asarray(vys, dtype=np.int32)[None, :]
+        inside = (next_xs >= 0) & (next_xs < n_rows) & (next_ys >= 0) & (next_ys < n_cols)
+        delta = np.abs(land_map.data[np.where(inside, next_xs, 0), np.where(inside, next_ys, 0)] - np.float64(height))
+        delta[~inside] = np.inf
+        best = np.argmin(delta, axis=1)
+        index = np.arange(len(self))
+        matched = delta[index, best] < c
+        return CandidateSet(xs=next_xs[index, best][matched], ys=next_ys[index, best][matched])
+
+
+@dataclass
+class ShiftedSet:
+    """
+    Shifted candidates with the map heights under them.
+    """
+    xs: np.ndarray
+    ys: np.ndarray
+    heights: np.ndarray
+
+    def filter_by_height(self, height: int, c: int) -> CandidateSet:
+        """
+        Keep candidates with height within (-c, c) of `height`, same as `CandidateSet.filter_by_task`.
+        """
+        delta = np.int64(height) - self.heights
+        matched = (delta > -c) & (delta < c)
+        return CandidateSet(xs=self.xs[matched], ys=self.ys[matched])
+
+
+@dataclass
+class PendingWork:
+    """
+    Candidates that still have to be advanced through the listed (vx, vy, height) steps.
+    """
+    candidates: CandidateSet
+    steps: List[Tuple[Motion, Motion, int]]
+
+
+def shift_grid(mask: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """
+    Shift boolean grid by (dx, dy), cells leaving the grid are dropped.
+    """
+    n_rows, n_cols = mask.shape
+    shifted = np.zeros_like(mask)
+    if abs(dx) >= n_rows or abs(dy) >= n_cols:
+        return shifted
+    shifted[max(dx, 0):n_rows + min(dx, 0), max(dy, 0):n_cols + min(dy, 0)] = \
+        mask[max(-dx, 0):n_rows + min(-dx, 0), max(-dy, 0):n_cols + min(-dy, 0)]
+    return shifted
+
+
+def shift_grid_any(mask: np.ndarray, dx: Motion, dy: Motion) -> np.ndarray:
+    """
+    Union of the grid shifted by every (dx, dy) hypothesis.
+    """
+    if not isinstance(dx, tuple):
+        return shift_grid(mask, dx, dy)
+    shifted = np.zeros_like(mask)
+    for hypothesis_dx, hypothesis_dy in zip(dx, dy):
+        shifted |= shift_grid(mask, hypothesis_dx, hypothesis_dy)
+    return shifted
+
+
+@dataclass
+class CandidateGrid(BaseCandidates):
+    """
+    Candidates as a boolean grid of the map size.
+    Filtering cost does not depend on the number of candidates.
+    """
+    mask: np.ndarray
+
+    @classmethod
+    def from_coords(cls, xs: np.ndarray, ys: np.ndarray, shape: Tuple[int, int]) -> 'CandidateGrid':
+        mask = np.zeros(shape, dtype=bool)
+        mask[xs, ys] = True
+        return cls(mask=mask)
+
+    @classmethod
+    def unpack(cls, packed: np.ndarray, shape: Tuple[int, int]) -> 'CandidateGrid':
+        """
+        Restore grid from the `pack` output.
+        """
+        return cls(mask=np.unpackbits(packed, count=shape[0] * shape[1]).view(bool).reshape(shape))
+
+    def pack(self) -> np.ndarray:
+        """
+        Pack grid into bits (1081x1081 map takes ~146 KB).
+        """
+        return np.packbits(self.mask)
+
+    def coords(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Candidate coordinates in column-major order.
+        """
+        ys, xs = np.nonzero(self.mask.T)
+        return xs, ys
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+    def __getitem__(self, item: int) -> Tuple[int, int]:
+        xs, ys = self.coords()
+        return int(xs[item]), int(ys[item])
+
+    def head(self, size: int) -> 'CandidateGrid':
+        xs, ys = self.coords()
+        return CandidateGrid.from_coords(xs[:size], ys[:size], self.mask.shape)
+
+    def filter_by_task(self, land_map: Map, vx: int, vy: int, height: int, c: int) -> 'CandidateGrid':
+        shifted = shift_grid(self.mask, vx, vy)
+        return CandidateGrid(mask=land_map.pyramid.mask(height - c, height + c, where=shifted, inclusive=False))
+
+    def filter_by_hypotheses(self, land_map: Map, vxs: Tuple[int, ...], vys: Tuple[int, ...], height: int,
+                             c: int) -> 'CandidateGrid':
+        # grid can't track which hypothesis each cell took, so all matching ones are kept
+        shifted = shift_grid_any(self.mask, vxs, vys)
+        return CandidateGrid(mask=land_map.pyramid.mask(height - c, height + c, where=shifted, inclusive=False))
+
+
+@dataclass
+class GridGeneration:
+    """
+    Packed past candidates grid with the shifts applied after it.
+    """
+    packed: np.ndarray
+    steps: List[Tuple[Motion, Motion]] = field(default_factory=list)
+
+
+class CandidateHistory:
+    """
+    Ring buffer of past candidate grids, used to back off when filtering leaves no candidates.
+    """
+
+    def __init__(self, shape: Tuple[int, int], size: int):
+        self.shape = shape
+        self._generations: Deque[GridGeneration] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._generations)
+
+    def push(self, grid: CandidateGrid, vx: Motion, vy: Motion) -> None:
+        """
+        Store the grid that is about to be shifted by (vx, vy).
+        """
+        for generation in self._generations:
+            generation.steps.append((vx, vy))
+        self._generations.append(GridGeneration(packed=grid.pack(), steps=[(vx, vy)]))
+
+    def back_off(self, land_map: Map, height: int, c: int) -> Optional[CandidateGrid]:
+        """
+        Replay older generations skipping the height checks of the steps after them.
+        Newest generations are tried first, the last pushed one is skipped since it has just been filtered.
+        :return: First non-empty replayed grid or None.
+        """
+        for generation in list(self._generations)[-2::-1]:
+            mask = CandidateGrid.unpack(generation.packed, self.shape).mask
+            for vx, vy in generation.steps:
+                mask = shift_grid_any(mask, vx, vy)
+            grid = CandidateGrid(mask=land_map.pyramid.mask(height - c, height + c, where=mask, inclusive=False))
+            if grid:
+                logger.warning(f"[candidates: {len(grid)}] Backed off {len(generation.steps)} steps")
+                return grid
+        return None
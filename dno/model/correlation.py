@@ -0,0 +1,150 @@
+from dno.proto.data import Task, Solution, Map
+import numpy as np
+from typing import List, Optional, Tuple
+from time import time
+from loguru import logger
+
+
+class CorrelationModel:
+    """
+    Localization by matching the whole height profile of the trajectory against the map.
+    Every map cell is kept as a starting point hypothesis and scored by the sum of squared
+    height differences along the trajectory (sliding-window SSD), so the cost depends
+    on the map size only and not on the number of hypotheses.
+    The position is reported only once the best start clearly beats every start away from it,
+    flat areas match many starts equally well.
+    """
+
+    def __init__(self, map_raw: Map, window: int=30, speed_scale: float=1.,
+                 time_limit: Optional[float]=1.8, min_ratio: float=2., min_margin: float=None,
+                 exclusion: int=3):
+        """
+        :param min_ratio:  Cost of the second best start over the cost of the best one needed to report.
+        :param min_margin: Cost difference of the second best and the best starts needed to report,
+                           `window` squared tolerances by default.
+        :param exclusion:  Starts within this distance of the best one are not counted as the second best.
+        """
+        self.map: Map = map_raw
+        self.map_arr: np.ndarray = map_raw.data
+        self.n: int = map_raw.data.shape[0]
+        self.window = window
+        self.speed_scale = speed_scale
+        self.min_ratio = min_ratio
+        self.min_margin = min_margin if min_margin is not None else window * 400. ** 2
+        self.exclusion = exclusion
+        self.ready: bool = False
+        self.coords: Tuple[float, float] = None
+        self.last_speed: float = None
+        # trajectory relative to the first point: row (y) and column (x) offsets
+        self._offsets: List[Tuple[float, float]] = []
+        self._heights: List[int] = []
+        # per starting cell: sum of squared height errors over the last `window` points
+        self._sum_sq: np.ndarray = None
+        # last unambiguous starting cell
+        self._start: Tuple[int, int] = None
+        # TIME LIMITS HANDLING
+        self._task_handle_start_time = None
+        self._time_limit = time_limit
+
+    def start_timing(self):
+        self._task_handle_start_time = time()
+
+    @property
+    def has_time(self) -> bool:
+        """
+        Check if has time in time limit
+        """
+        if self._time_limit is not None:
+            return (time() - self._task_handle_start_time) < self._time_limit
+        return True
+
+    @property
+    def phase(self) -> str:
+        """
+        Kind of work the next handled task does: buffering, matching (the batched pass) or tracking.
+        """
+        if len(self._offsets) + 1 < self.window:
+            return 'buffering'
+        return 'matching' if len(self._offsets) + 1 == self.window else 'tracking'
+
+    def handle_task(self, task: Task) -> Solution:
+        self.start_timing()
+        if task.speed == 0 and self.last_speed is not None:
+            task.speed = self.last_speed
+            logger.debug("Not inferencing speed")
+        self.last_speed = task.speed
+        if self._offsets:
+            row, col = self._offsets[-1]
+            self._offsets.append((row + task.vy * self.speed_scale, col + task.vx * self.speed_scale))
+        else:
+            self._offsets.append((0., 0.))
+        self._heights.append(task.height)
+        if len(self._offsets) == self.window:
+            self._sum_sq = np.zeros(self.map_arr.shape, dtype=np.float64)
+            for offset, height in zip(self._offsets, self._heights):
+                self._accumulate(offset, height)
+        elif len(self._offsets) > self.window:
+            # slide the window: add the new point and drop the one leaving it
+            self._accumulate(self._offsets[-1], self._heights[-1])
+            self._accumulate(self._offsets[-self.window - 1], self._heights[-self.window - 1], sign=-1.)
+        if self._sum_sq is not None:
+            self._locate()
+        if not self.has_time:
+            logger.warning(f"[step: {len(self._offsets)}] Matching exceeded time limit ({self._time_limit})")
+        return self._get_solution()
+
+    def _accumulate(self, offset: Tuple[float, float], height: int, sign: float=1.):
+        """
+        Add (or remove with `sign` -1) squared height error of a single trajectory point for all starting cells at once.
+        """
+        n_rows, n_cols = self.map_arr.shape
+        d_row, d_col = int(round(offset[0])), int(round(offset[1]))
+        if abs(d_row) >= n_rows or abs(d_col) >= n_cols:
+            return
+        # starting cells whose point lands inside the map
+        rows = slice(max(0, -d_row), n_rows - max(0, d_row))
+        cols = slice(max(0, -d_col), n_cols - max(0, d_col))
+        shifted = self.map_arr[max(0, d_row):n_rows + min(0, d_row), max(0, d_col):n_cols + min(0, d_col)]
+        self._sum_sq[rows, cols] += sign * np.square(shifted - np.float64(height))
+
+    def _valid_starts(self) -> Tuple[slice, slice]:
+        """
+        Starting cells keeping every point of the window inside the map.
+        """
+        n_rows, n_cols = self.map_arr.shape
+        d_rows, d_cols = zip(*((int(round(row)), int(round(col))) for row, col in self._offsets[-self.window:]))
+        return (slice(max(0, -min(d_rows)), max(0, n_rows - max(0, max(d_rows)))),
+                slice(max(0, -min(d_cols)), max(0, n_cols - max(0, max(d_cols)))))
+
+    def _locate(self):
+        """
+        Update the starting cell if the best match is unambiguous, the position follows the last accepted one.
+        """
+        rows, cols = self._valid_starts()
+        cost = np.full(self.map_arr.shape, np.inf)
+        cost[rows, cols] = self._sum_sq[rows, cols]
+        start = np.unravel_index(np.argmin(cost), cost.shape)
+        best = cost[start]
+        if not np.isfinite(best):
+            logger.warning("Trajectory left the map for every starting point")
+        else:
+            # the neighbours of the best start match almost as well, the competitor has to be elsewhere
+            cost[max(0, start[0] - self.exclusion):start[0] + self.exclusion + 1,
+                 max(0, start[1] - self.exclusion):start[1] + self.exclusion + 1] = np.inf
+            second = cost.min()
+            if second >= self.min_ratio * best and second - best >= self.min_margin:
+                self._start = int(start[0]), int(start[1])
+                logger.debug(f"Best start: {start} with cost {best}, second best cost {second}")
+            else:
+                logger.debug(f"Ambiguous start: {start} with cost {best}, second best cost {second}")
+        if self._start is None:
+            return
+        row, col = self._offsets[-1]
+        self.coords = max(0., col + self._start[1]), max(0., row + self._start[0])
+        self.ready = True
+
+    def _get_solution(self) -> Solution:
+        if not self.ready:
+            return Solution(ready=False)
+        else:
+            return Solution(x=self.coords[0], y=self.coords[1], ready=True)
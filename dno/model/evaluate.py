@@ -0,0 +1,101 @@
+"""
+Parallel offline evaluation: tasks are spread over a process pool,
+decoded maps are shared with the workers through shared memory instead of pickling.
+"""
+import json
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from typing import Type, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+
+from dno.model.model import Model
+from dno.model.scoring import score
+from dno.model.replay import replay_tasks, MODELS
+from dno.proto import utils
+from dno.proto.cache import MapCache
+from dno.proto.columnar import open_session
+from dno.proto.data import Map
+
+
+def _share_map(land_map: Map) -> SharedMemory:
+    shared = SharedMemory(create=True, size=land_map.data.nbytes)
+    np.ndarray(land_map.data.shape, dtype=land_map.data.dtype, buffer=shared.buf)[:] = land_map.data
+    return shared
+
+
+def _evaluate_task(model_class: Type[Model], task_num: int, shared_name: str,
+                   shape: Tuple[int, int], dtype: str) -> dict:
+    """
+    Worker: attach to the shared map and replay the task.
+    """
+    logger.disable('dno')
+    shared = SharedMemory(name=shared_name)
+    try:
+        land_map = Map(data=np.ndarray(shape, dtype=dtype, buffer=shared.buf))
+        land_map.data.flags.writeable = False
+        start = time.perf_counter()
+        mse = replay_tasks(model_class(land_map), land_map,
+                           open_session(utils.get_session_path(task_num)).iter_tasks())
+        seconds = time.perf_counter() - start
+        # views of the shared buffer have to be released before closing it
+        del land_map
+        return {"task": task_num, "mse": mse, "score": score(mse), "seconds": seconds}
+    finally:
+        shared.close()
+
+
+def evaluate_tasks(task_nums: Sequence[int], model_class: Type[Model]=Model, jobs: Optional[int]=None,
+                   map_cache: Optional[MapCache]=None) -> List[dict]:
+    """
+    Evaluate the model on all tasks in parallel.
+    :param jobs: Number of worker processes, all cores by default.
+    :return:     Report row per task sorted by task number.
+    """
+    shared_maps: List[SharedMemory] = []
+    report = []
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {}
+            for task_num in task_nums:
+                land_map = open_session(utils.get_session_path(task_num)).read_map(map_cache)
+                shared = _share_map(land_map)
+                shared_maps.append(shared)
+                future = pool.submit(_evaluate_task, model_class, task_num, shared.name,
+                                     land_map.data.shape, land_map.data.dtype.str)
+                futures[future] = task_num
+            for future in as_completed(futures):
+                row = future.result()
+                logger.success(f"Task: {row['task']} MSE: {row['mse']} ({row['seconds']:.2f} s)")
+                report.append(row)
+    finally:
+        for shared in shared_maps:
+            shared.close()
+            shared.unlink()
+    return sorted(report, key=lambda row: row["task"])
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("task_nums", type=int, nargs='+', metavar="task_nums",
+                        help="task numbers to evaluate, -1 for all tasks")
+    parser.add_argument("--model", type=str, choices=list(MODELS), default='model',
+                        help="localization engine to use")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--report", type=str, default=None, help="path to write JSON report to")
+    args = parser.parse_args()
+    if len(args.task_nums) == 1 and args.task_nums[0] == -1:
+        args.task_nums = list(range(1, 32))
+    report = evaluate_tasks(args.task_nums, MODELS[args.model], jobs=args.jobs)
+    mean_mse = float(np.mean([row["mse"] for row in report]))
+    logger.success(f"Mean MSE over {len(report)} tasks: {mean_mse}, score: {score(mean_mse):.2f}")
+    if args.report is not None:
+        with open(args.report, 'w') as file:
+            json.dump({"mean_mse": mean_mse, "tasks": report}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,50 @@
-from copy import deepcopy
 from dno.proto.data import Task, Solution, Map
+from dno.model.candidates import BaseCandidates, CandidateSet, CandidateGrid, CandidateHistory, PendingWork, \
+    ShiftedSet, advance
+from dno.proto.trace import TRACER, traced
 import numpy as np
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, replace
+from typing import Optional, Tuple, List, Sequence, Dict
 from time import time
 from loguru import logger
 
 
+@dataclass
+class Speculation:
+    """
+    Candidates shifted ahead of time by the likely next displacements.
+    """
+    candidates: BaseCandidates
+    shifted: Dict[Tuple[int, int], ShiftedSet]
+
+
 class Model:
-    def __init__(self, map_raw: Map, c: int=400, max_candidates: int=200_000,
-                 time_limit: Optional[float]=1.8, enable_infer_speed: bool=False):
+    def __init__(self, map_raw: Map, c: int=400, max_candidates: int=2_000_000,
+                 time_limit: Optional[float]=1.8, enable_infer_speed: bool=False,
+                 use_bitmap: bool=False, history_size: int=4, chunk_size: int=262_144,
+                 heading_offsets: Sequence[float]=(0,), speculate: bool=False,
+                 speculation_speeds: Sequence[int]=(0,)):
         self.max_candidates = max_candidates
         self.enable_infer_speed = enable_infer_speed
+        self.heading_offsets = heading_offsets
+        self.use_bitmap = use_bitmap
+        self.chunk_size = chunk_size
+        self.map: Map = map_raw
         self.n: int = map_raw.data.shape[0]
         self.map_arr: np.ndarray = map_raw.data
-        self.candidates: List[(int, int)] = []
-        self.prev_cands: List[(int, int)] = []
+        self.candidates: BaseCandidates = CandidateSet.empty()
+        self.prev_cands: BaseCandidates = CandidateSet.empty()
+        self.history: CandidateHistory = CandidateHistory(self.map_arr.shape, history_size)
+        # candidates deferred by the time limit or the candidates cap, resumed on the next steps
+        self.pending: List[PendingWork] = []
         self.c: int = c
+        # shifting candidates for the next step in the background while waiting for the next task,
+        # speed offsets from the last task speed are the displacements tried
+        self.speculation_speeds = speculation_speeds
+        self._speculator: Optional[ThreadPoolExecutor] = \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix='speculation') if speculate else None
+        self._speculation: Optional[Future] = None
         self.ready: bool = False
         self.coords: (int, int) = None
         self.last_speed: float = None
@@ -35,40 +64,64 @@ class Model:
             return (time() - self._task_handle_start_time) < self._time_limit
         return True
 
-    def infer_speed(self, task: Task) -> int:
+    @property
+    def phase(self) -> str:
+        """
+        Kind of work the next handled task does: seeding, filtering or dead reckoning.
+        """
+        if self.ready:
+            return 'dead_reckoning'
+        return 'filtering' if self.candidates or self.pending else 'seeding'
+
+    def motion_hypotheses(self, task: Task) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Grid of speeds around the last known speed and heading offsets around the task heading.
+        :return: Speed, vx and vy of every hypothesis.
+        """
+        base_speed = int(self.last_speed)
+        speeds = np.arange(max(1, base_speed - 2), base_speed + 2)
+        psi = np.deg2rad(task.psi + np.asarray(self.heading_offsets, dtype=np.float64))
+        speeds, psi = (grid.ravel() for grid in np.meshgrid(speeds, psi, indexing='ij'))
+        return speeds, speeds * np.sin(psi), speeds * np.cos(psi)
+
+    @traced('model.infer_motion')
+    def infer_motion(self, task: Task) -> Tuple[float, float]:
+        """
+        Pick the motion hypothesis whose destination height is the closest to the task one.
+        Sets the inferred speed to the task.
+        :return: Displacement of the best hypothesis.
+        """
         x, y = self.coords
-        new_speed = task.speed
-        task_tmp = deepcopy(task)
-        best_delta = None
-        min_possible_speed = max(1, int(self.last_speed)-2)
-        max_possible_speed = int(self.last_speed) + 2
-        for i in range(min_possible_speed, max_possible_speed):
-            task_tmp.speed = i
-            task_tmp.x, task_tmp.y = self.clip_coordinates(x + task_tmp.vx, y + task_tmp.vy)
-            delta_tmp = abs(task.height - self.map_arr[int(task_tmp.x-1)][int(task_tmp.y-1)])
-            if best_delta is None or best_delta > delta_tmp:
-                best_delta = delta_tmp
-                new_speed = task_tmp.speed
-        return new_speed
+        speeds, vxs, vys = self.motion_hypotheses(task)
+        new_xs, new_ys = np.clip(x + vxs, 0, self.n), np.clip(y + vys, 0, self.n)
+        heights = self.map_arr[(new_xs - 1).astype(int), (new_ys - 1).astype(int)]
+        best = int(np.argmin(np.abs(heights - np.float64(task.height))))
+        task.speed = int(speeds[best])
+        return float(vxs[best]), float(vys[best])
 
     def handle_task(self, task: Task) -> Solution:
         self.start_timing()
         if not self.ready:
             self._find_candidates(task)
-            if len(self.candidates) == 1:
+            if task.speed != 0:
+                self.last_speed = task.speed
+            if len(self.candidates) == 1 and not self.pending:
                 self.ready = True
                 y, x = self.candidates[0]
                 self.coords = x, y
+            else:
+                self._speculate(task)
         else:
-            if task.speed == 0:
-                if not self.enable_infer_speed:
+            if task.speed == 0 and self.enable_infer_speed and self.last_speed:
+                vx, vy = self.infer_motion(task)
+                logger.debug(f"Inferencing speed: {task.speed}")
+            else:
+                if task.speed == 0:
                     task.speed = self.last_speed
                     logger.debug("Not inferencing speed")
-                else:
-                    task.speed = self.infer_speed(task)
-                    logger.debug(f"Inferencing speed: {task.speed}")
+                vx, vy = task.vx, task.vy
             x, y = self.coords
-            new_x, new_y = x + task.vx, y + task.vy
+            new_x, new_y = x + vx, y + vy
             new_x, new_y = self.bound_coordinates(new_x, new_y)
             self.coords = max(0, new_x), max(0, new_y)  # KOSTYL for negative solutions
             self.last_speed = task.speed
@@ -103,44 +156,125 @@ class Model:
             return Solution(x=self.coords[0], y=self.coords[1], ready=True)
 
     def _find_candidates(self, task: Task):
-        if not self.candidates:
+        if self.phase == 'seeding':
             self._init_candidates(task)
         else:
             self.prev_cands = self.candidates
             self.candidates = self._filter_by_task(task)
         logger.info(f"Find candidates returned: {len(self.candidates)}")
+        TRACER.gauge('model.candidates', len(self.candidates))
 
+    @traced('model.init_candidates')
     def _init_candidates(self, task: Task):
-        for i in range(0, self.n):
-            for j in range(0, self.n):
-                delta = task.height - self.map_arr[j][i]
-                # noinspection PyChainedComparisons
-                if delta >= -self.c and delta <= self.c:
-                    self.candidates.append([j, i])
-            if not self.has_time:
-                logger.warning(f"[candidates: {len(self.candidates)}] Breaking due to time limit ({self._time_limit})")
-                return
-            if self.max_candidates is not None and len(self.candidates) > self.max_candidates:
-                logger.warning(f"[candidates: {len(self.candidates)}] Breaking since "
+        if self.use_bitmap:
+            mask = self.map.pyramid.mask(task.height - self.c, task.height + self.c)
+            candidates = CandidateGrid(mask=mask)
+        else:
+            # the most promising cells (closest heights) go first
+            rows, cols = self.map.height_index.query(task.height, self.c, by_distance=True)
+            candidates = CandidateSet.from_coords(rows, cols)
+        if self.max_candidates is not None and len(candidates) > self.max_candidates:
+            if self.use_bitmap:
+                logger.warning(f"[candidates: {len(candidates)}] Truncating since "
                                f"number of candidates > max ({self.max_candidates})...")
-                return
-
-    def _filter_by_task(self, task: Task):
-        next_candidates = []
-        vx = int(round(task.vx))
-        vy = int(round(task.vy))
-        for candidate in self.candidates:
-            next_x = candidate[0] + vx
-            next_y = candidate[1] + vy
-            if self.n > next_x >= 0 and self.n > next_y >= 0:
-                delta = task.height - self.map_arr[next_x][next_y]
-                # noinspection PyChainedComparisons
-                if delta > -self.c and delta < self.c:
-                    next_candidates.append([next_x, next_y])
+            else:
+                logger.warning(f"[candidates: {len(candidates)}] Deferring candidates over max "
+                               f"({self.max_candidates}) to the next steps...")
+                self.pending.append(PendingWork(candidates=candidates.tail(self.max_candidates), steps=[]))
+            candidates = candidates.head(self.max_candidates)
+        self.candidates = candidates
+        if not self.has_time:
+            logger.warning(f"[candidates: {len(self.candidates)}] Seeding exceeded time limit ({self._time_limit})")
+
+    @traced('model.filter_by_task')
+    def _filter_by_task(self, task: Task) -> BaseCandidates:
+        if task.speed == 0 and self.enable_infer_speed and self.last_speed:
+            _, vxs, vys = self.motion_hypotheses(task)
+            moves = np.unique(np.stack((np.round(vxs), np.round(vys)), axis=1).astype(int), axis=0)
+            vx, vy = tuple(moves[:, 0].tolist()), tuple(moves[:, 1].tolist())
+            logger.debug(f"Inferencing motion over {len(moves)} hypotheses")
+        else:
+            vx = int(round(task.vx))
+            vy = int(round(task.vy))
+        if self.use_bitmap:
+            next_candidates = advance(self.candidates, self.map, vx, vy, task.height, self.c)
             if not self.has_time:
-                logger.warning(f"[candidates: {len(next_candidates)}] Breaking due to time limit...")
-                break
-        if not next_candidates:
+                logger.warning(f"[candidates: {len(next_candidates)}] Filtering exceeded time limit...")
+            self.history.push(self.candidates, vx, vy)
+            if not next_candidates:
+                next_candidates = self.history.back_off(self.map, task.height, self.c) or next_candidates
+        else:
+            speculated = self._take_speculation(vx, vy)
+            if speculated is not None:
+                next_candidates = speculated.filter_by_height(task.height, self.c)
+            else:
+                step = (vx, vy, task.height)
+                work = [PendingWork(candidates=self.candidates, steps=[step])]
+                work += [PendingWork(candidates=item.candidates, steps=item.steps + [step]) for item in self.pending]
+                next_candidates = self._advance(work)
+        if not next_candidates and not self.pending:
             logger.warning(f"No new candidates selected, selecting first from first...")
-            next_candidates = [self.prev_cands[0]]
+            next_candidates = self.prev_cands.head(1)
         return next_candidates
+
+    def predict_moves(self, task: Task) -> List[Tuple[int, int]]:
+        """
+        Likely displacements of the next step: the heading of the task with speeds around its speed.
+        """
+        moves = []
+        for offset in self.speculation_speeds:
+            speed = task.speed + offset
+            if speed >= 0:
+                predicted = replace(task, speed=speed)
+                moves.append((int(round(predicted.vx)), int(round(predicted.vy))))
+        return list(dict.fromkeys(moves))
+
+    def _speculate(self, task: Task) -> None:
+        """
+        Start shifting the candidates by the predicted displacements in the background.
+        Only plain candidate sets without deferred work are speculated on.
+        """
+        self._speculation = None
+        if self._speculator is None or self.pending or not isinstance(self.candidates, CandidateSet):
+            return
+        if not self.candidates:
+            return
+        self._speculation = self._speculator.submit(self._precompute, self.candidates, self.predict_moves(task))
+
+    @traced('model.speculate')
+    def _precompute(self, candidates: CandidateSet, moves: List[Tuple[int, int]]) -> Speculation:
+        return Speculation(candidates=candidates,
+                           shifted={move: candidates.shift(self.map, *move) for move in moves})
+
+    def _take_speculation(self, vx, vy) -> Optional[ShiftedSet]:
+        """
+        Shifted candidates precomputed for the actual displacement, if any.
+        """
+        future, self._speculation = self._speculation, None
+        if future is None or self.pending or isinstance(vx, tuple):
+            return None
+        speculation = future.result()
+        shifted = speculation.shifted.get((vx, vy)) if speculation.candidates is self.candidates else None
+        TRACER.count('model.speculation.hits' if shifted is not None else 'model.speculation.misses')
+        return shifted
+
+    def _advance(self, work: List[PendingWork]) -> CandidateSet:
+        """
+        Advance candidates chunk by chunk in order while there is time.
+        Chunks left when the time is out are kept in `pending` and resumed on the next step.
+        """
+        queue = [PendingWork(candidates=chunk, steps=item.steps)
+                 for item in work for chunk in item.candidates.chunks(self.chunk_size)]
+        survivors = []
+        self.pending = []
+        for position, item in enumerate(queue):
+            if position > 0 and not self.has_time:
+                self.pending = queue[position:]
+                logger.warning(f"[candidates: {sum(map(len, survivors))}] Time limit reached, "
+                               f"deferring {len(self.pending)} chunks to the next step...")
+                break
+            candidates = item.candidates
+            for vx, vy, height in item.steps:
+                candidates = advance(candidates, self.map, vx, vy, height, self.c)
+            survivors.append(candidates)
+        return CandidateSet.concat(survivors)
@@ -0,0 +1,27 @@
+"""
+Models selectable from the command line tools and replay of recorded tasks through them.
+"""
+from functools import partial
+from typing import Iterable
+
+from dno.model.model import Model
+from dno.model.correlation import CorrelationModel
+from dno.model.scoring import ScoreAccumulator
+from dno.proto.data import Task, Map
+
+MODELS = {
+    'model': Model,
+    # filters the next step in the background while waiting on the backend
+    'speculative': partial(Model, speculate=True),
+    'correlation': CorrelationModel,
+}
+
+
+def replay_tasks(model, land_map: Map, tasks: Iterable[Task]) -> float:
+    """
+    Run the model over the tasks and compute its MSE.
+    """
+    accumulator = ScoreAccumulator(land_map.data.size)
+    for task in tasks:
+        accumulator.add(model.handle_task(task), task)
+    return accumulator.mse
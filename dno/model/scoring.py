@@ -0,0 +1,91 @@
+"""
+Scoring shared by all evaluators: per-step squared errors normalized by the map size,
+not ready steps cost NOT_READY_ERROR, score is 1000 * (1 - MSE).
+"""
+from typing import Sequence
+
+import numpy as np
+
+from dno.proto.data import Solution, Task, TaskBatch
+
+NOT_READY_ERROR = 0.5
+
+
+def step_errors(xs: np.ndarray, ys: np.ndarray, ready: np.ndarray, true_xs: np.ndarray, true_ys: np.ndarray,
+                map_cells: int) -> np.ndarray:
+    """
+    Error of every step.
+    :param map_cells: Number of cells in the map.
+    """
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    errors = (np.square(xs - true_xs) + np.square(ys - true_ys)) / map_cells
+    return np.where(np.asarray(ready, dtype=bool), errors, NOT_READY_ERROR)
+
+
+def solution_errors(solutions: Sequence[Solution], tasks: TaskBatch, map_cells: int) -> np.ndarray:
+    """
+    Error of every solution against the task it answers.
+    """
+    xs, ys, ready = (np.array(column, dtype=np.float64) for column in zip(*solutions)) if solutions else ([], [], [])
+    return step_errors(xs, ys, ready, tasks.x, tasks.y, map_cells)
+
+
+def answer_errors(answers: Sequence[dict], correct: Sequence[dict], map_cells: int) -> np.ndarray:
+    """
+    Error of every serialized solution against the serialized task it answers,
+    answers past the last task have nothing to miss and count as 0 like in the original scoring.
+    """
+    size = min(len(answers), len(correct))
+    columns = {key: np.fromiter((answer[key] for answer in answers[:size]), dtype=np.float64, count=size)
+               for key in ('x', 'y', 'ready')}
+    true_xs = np.fromiter((task['x'] for task in correct[:size]), dtype=np.float64, count=size)
+    true_ys = np.fromiter((task['y'] for task in correct[:size]), dtype=np.float64, count=size)
+    errors = step_errors(columns['x'], columns['y'], columns['ready'], true_xs, true_ys, map_cells)
+    return np.concatenate([errors, np.zeros(len(answers) - size)])
+
+
+def mse(errors: np.ndarray) -> float:
+    return float(np.mean(errors))
+
+
+def score(mse_value: float) -> float:
+    return 1000 * (1 - mse_value)
+
+
+class ScoreAccumulator:
+    """
+    Incremental scoring of solutions streaming out of a live or replayed session.
+    """
+
+    def __init__(self, map_cells: int):
+        self.map_cells = map_cells
+        self.steps: int = 0
+        self.total_error: float = 0.
+
+    def add(self, solution: Solution, task: Task) -> float:
+        """
+        Score a single solution.
+        :return: Error of the step.
+        """
+        if not solution.ready:
+            error = NOT_READY_ERROR
+        else:
+            error = ((solution.x - task.x) ** 2 + (solution.y - task.y) ** 2) / self.map_cells
+        self.steps += 1
+        self.total_error += error
+        return error
+
+    def add_errors(self, errors: np.ndarray) -> None:
+        """
+        Add already computed step errors.
+        """
+        self.steps += len(errors)
+        self.total_error += float(np.sum(errors))
+
+    @property
+    def mse(self) -> float:
+        return self.total_error / self.steps if self.steps else 0.
+
+    @property
+    def score(self) -> float:
+        return score(self.mse)
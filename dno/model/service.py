@@ -0,0 +1,291 @@
+"""
+Resident localization service: keeps decoded maps with their indexes in memory and hosts
+many concurrent model sessions, one per trajectory.
+Requests and responses use the backend framing (4-byte little-endian length-prefixed JSON):
+
+- {"open": {"map": [...]}} / {"open": {"map_key": key}} / {"open": {"task": N}} -> {"session": id, "map_key": key}
+- {"session": id, "data": {"x", "y", "height", "speed", "psi"}}               -> {"x", "y", "ready"}
+- {"close": id}                                                               -> {"closed": id}
+
+Errors are answered with {"error": message}.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import socket
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Type, Optional, Dict, Union, Tuple, Set
+
+from loguru import logger
+
+from dno.model.model import Model
+from dno.proto.backend import BackendInteraction
+from dno.proto.columnar import open_session, SESSION_SUFFIX
+from dno.proto.data import Map, Task, Solution, TaskReader
+from dno.proto.trace import TRACER, bind_session
+from dno.proto.utils import get_project_root
+
+
+class ServiceException(Exception):
+    """
+    Raises on invalid service requests: unknown map or session.
+    """
+
+
+@dataclass
+class ModelSession:
+    """
+    Model tracking a single trajectory, tasks of one session are handled strictly in order.
+    """
+    model: Model
+    map_key: str
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    steps: int = 0
+
+
+class LocalizationService:
+    """
+    Sessions share the Map objects, so the height index and the pyramid are built once per map
+    and stay warm between sessions.
+    """
+
+    def __init__(self, model_class: Type[Model]=Model, model_kwargs: Optional[dict]=None,
+                 data_dir: Optional[Union[str, Path]]=None, workers: Optional[int]=None):
+        self.model_class = model_class
+        self.model_kwargs = model_kwargs or {}
+        self.data_dir = Path(data_dir) if data_dir is not None else get_project_root() / 'data' / 'besthack19'
+        self.maps: Dict[str, Map] = {}
+        self.sessions: Dict[int, ModelSession] = {}
+        self._task_maps: Dict[int, str] = {}
+        self._session_ids = itertools.count(1)
+        # maps are registered in worker threads, the lock only guards the dicts,
+        # indexes of a map being loaded are built outside it and awaited through its future
+        self._maps_lock = threading.Lock()
+        self._loading: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._server: asyncio.AbstractServer = None
+        self.port: int = None
+
+    @staticmethod
+    def map_key(land_map: Map) -> str:
+        return hashlib.sha1(land_map.data.tobytes()).hexdigest()
+
+    def add_map(self, land_map: Map) -> str:
+        """
+        Register the map and build its indexes unless an equal map is already loaded.
+        :return: Key of the map for the following `open_session` calls.
+        """
+        key = self.map_key(land_map)
+        with self._maps_lock:
+            if key in self.maps:
+                return key
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = Future()
+                building = True
+            else:
+                building = False
+        if not building:
+            # the same map is being loaded by another request
+            return loading.result()
+        try:
+            logger.info(f"Loading map {key} {land_map.data.shape}...")
+            # indexes are built eagerly so concurrent sessions never race to build them
+            land_map.height_index, land_map.pyramid
+        except BaseException as e:
+            with self._maps_lock:
+                del self._loading[key]
+            loading.set_exception(e)
+            raise
+        with self._maps_lock:
+            self.maps[key] = land_map
+            del self._loading[key]
+        loading.set_result(key)
+        return key
+
+    def add_map_dict(self, data: dict) -> str:
+        """
+        Decode and register the map sent by a client.
+        """
+        return self.add_map(Map.from_dict(data))
+
+    def add_task_map(self, task_num: int) -> str:
+        """
+        Register the map of a recorded task.
+        """
+        if task_num not in self._task_maps:
+            path = self.data_dir / f'task{task_num}'
+            if not path.exists():
+                path = path.with_name(f'{path.name}{SESSION_SUFFIX}')
+            reader = open_session(path)
+            self._task_maps[task_num] = self.add_map(reader.read_map())
+        return self._task_maps[task_num]
+
+    def open_session(self, map_key: str) -> int:
+        """
+        Start a new trajectory on a loaded map.
+        :return: Session id.
+        """
+        if map_key not in self.maps:
+            raise ServiceException(f"Unknown map {map_key}")
+        session_id = next(self._session_ids)
+        self.sessions[session_id] = ModelSession(model=self.model_class(self.maps[map_key], **self.model_kwargs),
+                                                 map_key=map_key)
+        logger.debug(f"[session: {session_id}] Opened on map {map_key}, {len(self.sessions)} sessions")
+        return session_id
+
+    def close_session(self, session_id: int) -> None:
+        if self.sessions.pop(session_id, None) is None:
+            raise ServiceException(f"Unknown session {session_id}")
+        logger.debug(f"[session: {session_id}] Closed, {len(self.sessions)} sessions")
+
+    async def handle_task(self, session_id: int, task: Task) -> Solution:
+        """
+        Run the session model on the task in a worker thread.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise ServiceException(f"Unknown session {session_id}")
+        async with session.lock:
+            session.steps += 1
+            with TRACER.session(f'session{session_id}'):
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, bind_session(session.model.handle_task, task))
+
+    async def dispatch(self, request: dict, owned: Set[int]) -> dict:
+        """
+        Answer a single request, sessions opened by it are added to `owned`.
+        """
+        if "open" in request:
+            source = request["open"]
+            # decoding, hashing and indexing a map takes seconds, keep the event loop serving other sessions
+            loop = asyncio.get_running_loop()
+            if "map" in source:
+                key = await loop.run_in_executor(self._executor, self.add_map_dict, source)
+            elif "task" in source:
+                key = await loop.run_in_executor(self._executor, self.add_task_map, int(source["task"]))
+            else:
+                key = source.get("map_key")
+            session_id = self.open_session(key)
+            owned.add(session_id)
+            return {"session": session_id, "map_key": key}
+        if "close" in request:
+            self.close_session(int(request["close"]))
+            owned.discard(int(request["close"]))
+            return {"closed": request["close"]}
+        if "data" in request:
+            solution = await self.handle_task(int(request["session"]), Task.from_dict(request["data"]))
+            return solution.to_dict()
+        raise ServiceException(f"Unknown request {list(request)}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info('peername')
+        owned: Set[int] = set()
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(4), byteorder="little")
+                payload = await reader.readexactly(size)
+                # a failed request, including a model failure, must not drop the other sessions of the connection
+                try:
+                    response = await self.dispatch(json.loads(payload), owned)
+                except Exception as e:
+                    logger.warning(f"[{peer}] Request failed: {e!r}")
+                    response = {"error": f"{e!r}"}
+                writer.write(BackendInteraction.prepare_data(response))
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            logger.debug(f"[{peer}] Client disconnected")
+        finally:
+            # sessions don't outlive the connection which opened them
+            for session_id in owned:
+                self.sessions.pop(session_id, None)
+            writer.close()
+
+    async def start(self, host: str='127.0.0.1', port: int=4343) -> None:
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Localization service listening on {host}:{self.port}")
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> 'LocalizationService':
+        await self.start(port=0)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+
+class ServiceClient:
+    """
+    Blocking client of the localization service, single connection may drive several sessions.
+    """
+
+    def __init__(self, host: str='127.0.0.1', port: int=4343):
+        self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile('rb')
+
+    def request(self, data: dict) -> dict:
+        self._socket.sendall(BackendInteraction.prepare_data(data))
+        response = json.loads(TaskReader.read_next_packet(self._file))
+        if "error" in response:
+            raise ServiceException(response["error"])
+        return response
+
+    def open_session(self, land_map: Optional[Map]=None, map_key: Optional[str]=None,
+                     task: Optional[int]=None) -> Tuple[int, str]:
+        """
+        Open session by sending the map, referencing already loaded map or a recorded task.
+        :return: Session id and the map key.
+        """
+        if land_map is not None:
+            source = {"map": land_map.data.ravel().tolist()}
+        elif task is not None:
+            source = {"task": task}
+        else:
+            source = {"map_key": map_key}
+        response = self.request({"open": source})
+        return response["session"], response["map_key"]
+
+    def handle_task(self, session_id: int, task: Task) -> Solution:
+        response = self.request({"session": session_id, "data": task.to_dict()})
+        return Solution(x=response["x"], y=response["y"], ready=bool(response["ready"]))
+
+    def close_session(self, session_id: int) -> None:
+        self.request({"close": session_id})
+
+    def close(self) -> None:
+        self._file.close()
+        self._socket.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=4343)
+    parser.add_argument("--data-dir", type=str, default=None, help="directory with recorded sessions")
+    parser.add_argument("--workers", type=int, default=None, help="number of model worker threads")
+    parser.add_argument("--preload", type=int, nargs='*', default=[], help="recorded tasks whose maps to load")
+    args = parser.parse_args()
+    service = LocalizationService(data_dir=args.data_dir, workers=args.workers)
+    for task_num in args.preload:
+        service.add_task_map(task_num)
+
+    async def serve():
+        await service.start(args.host, args.port)
+        async with service._server:
+            await service._server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,27 @@
+import asyncio
 import time
 import numpy as np
 from typing import Type, Tuple, Optional
 
 from dno.model.model import Model
+from dno.model.replay import MODELS, replay_tasks
+from dno.model.scoring import score
 from dno.proto.backend import BackendInteraction
-from dno.proto.mock import TaskReader
+from dno.proto.async_backend import run_sessions
+from dno.proto.cache import MapCache
+from dno.proto.columnar import open_session
 from dno.proto.data import Task, Solution, Map
 from dno.proto import utils
+from dno.proto.trace import TRACER
 from loguru import logger
 from argparse import ArgumentParser, ArgumentTypeError
 
 
+BACKEND_HOST = 'besthack19.sytes.net'
+BACKEND_PORT = 4242
+BACKEND_AUTH = "exp3ct0pat5onum"
+
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -20,33 +31,23 @@ def str2bool(v):
         raise ArgumentTypeError('Boolean value expected.')
 
 
-def debug_task(model_class: Type[Model], task_num: int):
-    task_reader = TaskReader(utils.get_task_path(task_num))
-    land_map, tasks, _ = task_reader.read_all()
-    land_map = Map.from_dict(land_map)
+def debug_task(model_class: Type[Model], task_num: int, map_cache: Optional[MapCache]=None):
+    task_reader = open_session(utils.get_session_path(task_num))
+    land_map = task_reader.read_map(map_cache)
     model = model_class(land_map)
-    tasks = list(map(lambda t: Task.from_dict(t['data']), tasks))
-    mse = 0
-    for task in tasks:
-        sol = model.handle_task(task)
-        if not sol.ready:
-            mse += 0.5
-        else:
-            err = (sol.x - task.x) ** 2 + (sol.y - task.y) ** 2
-            err /= (land_map.data.shape[0] * land_map.data.shape[1])
-            mse += err
-    mse /= len(tasks)
+    mse = replay_tasks(model, land_map, task_reader.iter_tasks())
     logger.success(f'Task: {task_num} MSE: {mse}')
     return mse
 
 
-def run(task_num, model_class: Type[Model]=Model, debug: bool=True, prod: bool=True) -> Tuple[Optional[float], Optional[float]]:
-    backend = BackendInteraction(backend_host='besthack19.sytes.net', backed_port=4242, auth="exp3ct0pat5onum")
+def run(task_num, model_class: Type[Model]=Model, debug: bool=True, prod: bool=True,
+        map_cache: Optional[MapCache]=None) -> Tuple[Optional[float], Optional[float]]:
+    backend = BackendInteraction(backend_host=BACKEND_HOST, backed_port=BACKEND_PORT, auth=BACKEND_AUTH)
     debug_score = None
     prod_score = None
     if debug:
         logger.warning(f"RUNNING DEBUGGING FOR TASK {task_num}...")
-        debug_score = debug_task(model_class, task_num)
+        debug_score = debug_task(model_class, task_num, map_cache)
         logger.success(f"Final DEBUG score: {debug_score}")
     if debug and prod:
         logger.warning("WAITING SOME TIME FOR YOU TO SEE MUTHAR FACKER")
@@ -69,12 +70,23 @@ def main():
     parser.add_argument("task_nums", type=int, nargs='+', metavar="task_nums",
                         help="task number to test on",
                         default=default_task_num)
+    parser.add_argument("--model", type=str, choices=list(MODELS), default='model',
+                        help="localization engine to use")
     parser.add_argument("--debug", type=str2bool, nargs='?',
                         const=True, default=True,
                         help="enable or disable debug")
     parser.add_argument("--prod", type=str2bool, nargs='?',
                         const=True, default=True,
                         help="enable or disable prod")
+    parser.add_argument("--cache", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="enable or disable on-disk map cache for debug runs")
+    parser.add_argument("--sessions", type=int, default=1,
+                        help="number of concurrent prod sessions, more than 1 runs prod over asyncio")
+    parser.add_argument("--session-timeout", type=float, default=None,
+                        help="time limit for a single concurrent prod session")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="write hot path trace to the path (.json for Chrome trace, .csv for timeline)")
     parser.add_argument("--logs", type=str2bool, nargs='?',
                         const=True, default=True,
                         help="enable or disable summary")
@@ -92,15 +104,30 @@ def main():
         logger.disable('dno.model.model')
         logger.disable('dno.proto.data')
         logger.disable('dno.proto.backend')
+    map_cache = MapCache() if args.cache else None
+    if args.trace is not None:
+        TRACER.enable()
     time.sleep(2)
+    concurrent_prod = args.prod and args.sessions > 1
     for task in args.task_nums:
-        task_results[task] = run(task, debug=args.debug, prod=args.prod)
+        with TRACER.session(f'task{task}'):
+            task_results[task] = run(task, model_class=MODELS[args.model], debug=args.debug,
+                                     prod=args.prod and not concurrent_prod, map_cache=map_cache)
+    if concurrent_prod:
+        logger.warning(f"RUNNING PRODUCTION FOR {len(args.task_nums)} TASKS, {args.sessions} AT A TIME...")
+        prod_scores = asyncio.run(run_sessions(args.task_nums, MODELS[args.model], BACKEND_HOST, BACKEND_PORT,
+                                               BACKEND_AUTH, max_sessions=args.sessions,
+                                               session_timeout=args.session_timeout))
+        for task, prod_score in zip(args.task_nums, prod_scores):
+            task_results[task] = task_results[task][0], prod_score
+    if args.trace is not None:
+        TRACER.export(args.trace)
     if args.summary:
         logger.success(f"Summary for all {len(task_results)} tasks")
         for task_name, task_data in task_results.items():
             logger.success(f"Task {task_name}: "
-                           f"debug={f'{1000*(1-task_data[0]):.2f}' if task_data[0] is not None else 'N/A'}, "
-                           f"prod={f'{1000*(1-task_data[1]):.2f}' if task_data[1] is not None else 'N/A'}")
+                           f"debug={f'{score(task_data[0]):.2f}' if task_data[0] is not None else 'N/A'}, "
+                           f"prod={f'{score(task_data[1]):.2f}' if task_data[1] is not None else 'N/A'}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+"""
+Asyncio client for the backend, runs many task sessions concurrently over separate connections.
+"""
+import asyncio
+import json
+from concurrent.futures import Executor
+from typing import Union, Optional, List, Sequence, Callable, Any
+from loguru import logger
+
+from dno.proto.backend import BackendInteraction, BackendInteractionException
+from dno.proto.data import Map, Solution, Task, Results
+from dno.proto.trace import TRACER, bind_session
+
+
+class AsyncBackendInteraction:
+    """
+    Single task session speaking the same length-prefixed JSON protocol as BackendInteraction.
+    """
+
+    def __init__(self, backend_host: str, backed_port: int, auth: str, timeout: Optional[float]=None):
+        self.backend_host = backend_host
+        self.backend_port = backed_port
+        self._auth_data = auth
+        self.timeout = timeout
+
+        self._current_iteration: int = 0
+        self._finite_response: dict = None
+        self._task_name = None
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+
+    @property
+    def results(self) -> Optional[Results]:
+        if not self.session_ended:
+            return None
+        if "scores" in self._finite_response:
+            return Results.from_dict(self._finite_response)
+        raise BackendInteractionException(f"Unexpected final response: {self._finite_response}")
+
+    @property
+    def current_iteration(self) -> int:
+        return self._current_iteration
+
+    @property
+    def session_ended(self) -> bool:
+        return self._finite_response is not None
+
+    @property
+    def current_task(self) -> str:
+        return self._task_name
+
+    async def connect(self) -> None:
+        logger.info(f"Connecting to {self.backend_host}:{self.backend_port}...")
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.backend_host, self.backend_port), self.timeout)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer, self._reader = None, None
+
+    async def exchange(self, data: dict) -> bytes:
+        """
+        Send data and receive the raw response.
+        """
+        self._writer.write(BackendInteraction.prepare_data(data))
+        # waits while the transport buffer is full
+        await self._writer.drain()
+        size = int.from_bytes(await asyncio.wait_for(self._reader.readexactly(4), self.timeout), byteorder="little")
+        received = await asyncio.wait_for(self._reader.readexactly(size), self.timeout)
+        logger.debug(f"[{self._task_name}] Received {size} bytes")
+        return received
+
+    async def send_receive(self, data: dict) -> dict:
+        """
+        Sends and receives data from the backend
+        :param data: Data to send
+        :return: Received data
+        """
+        return json.loads(await self.exchange(data))
+
+    async def start_task(self, task_index: int) -> Map:
+        self._current_iteration = 0
+        self._finite_response = None
+        self._task_name = task_index
+        await self.close()
+        await self.connect()
+        return BackendInteraction.decode_map(await self.exchange({
+            "team": self._auth_data,
+            "task": task_index
+        }))
+
+    async def send_solution(self, solution: Solution) -> Union[Task, Results]:
+        self._current_iteration += 1
+        data = BackendInteraction.assert_data(await self.send_receive(solution.to_dict()))
+        if "data" in data:
+            return Task.from_dict(data["data"])
+        else:
+            self._finite_response = data
+            await self.close()
+            return self.results
+
+
+async def run_session(task_num: int, model_class: Callable[[Map], Any], backend_host: str, backend_port: int,
+                      auth: str, timeout: Optional[float]=None, executor: Optional[Executor]=None,
+                      session_id: Optional[str]=None) -> float:
+    """
+    Run a single task session, the model is run in the executor so other sessions keep going.
+    :param session_id: Trace session of the events, `task<N>` by default.
+    :return:           Final score of the session.
+    """
+    loop = asyncio.get_running_loop()
+    backend = AsyncBackendInteraction(backend_host, backend_port, auth, timeout=timeout)
+    # the coroutine runs in its own asyncio task, so the trace session doesn't leak to other sessions
+    with TRACER.session(session_id or f'task{task_num}'):
+        try:
+            land_map = await backend.start_task(task_num)
+            model = await loop.run_in_executor(executor, bind_session(model_class, land_map))
+            task = await backend.send_solution(Solution(ready=False))
+            while not backend.session_ended:
+                solution = await loop.run_in_executor(executor, bind_session(model.handle_task, task))
+                task = await backend.send_solution(solution)
+            logger.success(f"Task {task_num} PROD score: {backend.results.score}")
+            return backend.results.score
+        finally:
+            await backend.close()
+
+
+async def run_sessions(task_nums: Sequence[int], model_class: Callable[[Map], Any], backend_host: str,
+                       backend_port: int, auth: str, max_sessions: int=8, session_timeout: Optional[float]=None,
+                       timeout: Optional[float]=None, executor: Optional[Executor]=None
+                       ) -> List[Optional[float]]:
+    """
+    Run task sessions concurrently, at most `max_sessions` at a time.
+    :param session_timeout: Time limit for a whole session.
+    :param timeout:         Time limit for a single network operation.
+    :return:                Score of every session in the order of `task_nums`, None for failed sessions.
+    """
+    semaphore = asyncio.Semaphore(max_sessions)
+
+    async def bounded(index: int, task_num: int) -> Optional[float]:
+        async with semaphore:
+            session_id = f'{index}:task{task_num}'
+            try:
+                return await asyncio.wait_for(
+                    run_session(task_num, model_class, backend_host, backend_port, auth, timeout, executor,
+                                session_id=session_id),
+                    session_timeout)
+            # a dropped connection (IncompleteReadError), a bad reply or a model failure must not cancel
+            # the other sessions of the gather
+            except Exception as e:
+                logger.error(f"[session: {session_id}] Task {task_num} failed: {e!r}")
+                return None
+
+    return list(await asyncio.gather(*(bounded(index, task_num) for index, task_num in enumerate(task_nums))))
@@ -1,10 +1,11 @@
 import json
-import socket
-from typing import Union, Optional, Tuple
+from typing import Union, Optional
 from loguru import logger
 
 from dno.proto.base import BaseInteropBackend
-from dno.proto.data import Map, Solution, Task, Results, TaskReader
+from dno.proto.data import Map, Solution, Task, Results
+from dno.proto.trace import TRACER
+from dno.proto.transport import Transport
 
 
 class BackendInteractionException(Exception):
@@ -27,7 +28,7 @@ class BackendInteraction(BaseInteropBackend):
         self._current_iteration: int = 0
         self._finite_response: dict = None
         self._task_name = None
-        self._stored_connection = None
+        self._stored_connection: Optional[Transport] = None
 
         # Set result
         self._actual_score: Results = None
@@ -47,16 +48,12 @@ class BackendInteraction(BaseInteropBackend):
     def current_iteration(self) -> int:
         return self._current_iteration
 
-    def make_session(self, use_cache=True) -> socket.SocketType:
-        if self._stored_connection is None or not use_cache:
-            tmp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            logger.info(f"Connectig to {self.backend_host}:{self.backend_port}...")
-            tmp_socket.connect((self.backend_host, self.backend_port))
-            self._stored_connection = tmp_socket
-            return tmp_socket
-        else:
-            # connection already exists, return it
-            return self._stored_connection
+    def make_session(self, use_cache=True) -> Transport:
+        if self._stored_connection is None:
+            self._stored_connection = Transport(self.backend_host, self.backend_port)
+        if not self._stored_connection.connected or not use_cache:
+            self._stored_connection.reconnect()
+        return self._stored_connection
 
     @property
     def session_ended(self) -> bool:
@@ -65,7 +62,12 @@ class BackendInteraction(BaseInteropBackend):
     def send_solution(self, solution: Solution) -> Union[Task, Results]:
         logger.info(f"Sending solution: {solution} for iteration: {self.current_iteration}")
         self._current_iteration += 1
-        data = self.send_receive(solution.to_dict())
+        try:
+            data = self.send_receive(Transport.encode_solution(solution))
+        except (ConnectionError, ValueError) as e:
+            # backend session is bound to the connection, so it can't be resumed after a reconnect
+            self.session.close()
+            raise BackendInteractionException(f"Connection lost on iteration {self.current_iteration}: {e!r}") from e
         self.assert_data(data)
         if "data" in data:
             return Task.from_dict(data["data"])
@@ -77,7 +79,6 @@ class BackendInteraction(BaseInteropBackend):
         self._current_iteration = 0
         self._finite_response = None
         self._task_name = None
-        self._stored_connection = None
 
     def build_start_task_message(self, task_index: int):
         return {
@@ -92,19 +93,29 @@ class BackendInteraction(BaseInteropBackend):
         return msg_size + msg_bytes
 
     @property
-    def session(self) -> Optional[socket.SocketType]:
+    def session(self) -> Optional[Transport]:
         return self._stored_connection
 
-    def send_receive(self, data: dict) -> dict:
+    def exchange(self, data: Union[dict, bytes]) -> bytearray:
+        """
+        Send data and receive the raw response.
+        """
+        logger.debug(f"Sending data: {data}")
+        with TRACER.span('backend.send'):
+            self.session.send(data)
+        with TRACER.span('backend.receive'):
+            return self.session.receive()
+
+    def send_receive(self, data: Union[dict, bytes]) -> dict:
         """
         Sends and receives data from the backend
-        :param data: Data to send
+        :param data: Data to send, dictionary or encoded JSON
         :return: Received data
         """
-        logger.debug(f"Sending data: {data}")
-        self.session.send(self.prepare_data(data))
-        received = TaskReader.read_next_response(socket.SocketIO(self.session, mode='rb'))
-        logger.debug(f"Received data: {str(received)[:70]} ({len(str(received))} bytes)")
+        raw = self.exchange(data)
+        with TRACER.span('backend.decode', size=len(raw)):
+            received = json.loads(raw)
+        logger.debug(f"Received data: {raw[:70]} ({len(raw)} bytes)")
         return received
 
     @staticmethod
@@ -113,16 +124,33 @@ class BackendInteraction(BaseInteropBackend):
             raise BackendInteractionException(f"Assertion error on response from server: {data}")
         return data
 
+    @staticmethod
+    def decode_map(raw: Union[bytes, bytearray]) -> Map:
+        """
+        Decode map packet, raising on the backend errors.
+        """
+        with TRACER.span('backend.decode', size=len(raw)):
+            try:
+                return Map.from_bytes(raw)
+            except ValueError:
+                # not a map, the backend must have answered with an error
+                BackendInteraction.assert_data(json.loads(raw))
+                raise
+
     def start_task(self, task_index: int) -> Map:
         # 1. Open session if it is None
         self._reset()
         self._task_name = task_index
         self.make_session(use_cache=False)
         # 2. Form msg in required format (bytes)
-        # 3. Send msg to backend
-        map_data = self.send_receive(self.build_start_task_message(task_index))
-        self.assert_data(map_data)
-        return Map.from_dict(map_data)
+        # 3. Send msg to backend, nothing is lost yet if the fresh connection drops, so it is retried once
+        try:
+            raw = self.exchange(self.build_start_task_message(task_index))
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Connection failed on task start ({e!r}), reconnecting...")
+            self.make_session(use_cache=False)
+            raw = self.exchange(self.build_start_task_message(task_index))
+        return self.decode_map(raw)
 
     @property
     def current_task(self) -> str:
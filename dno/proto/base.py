@@ -7,7 +7,7 @@ from typing import Union, Optional, Tuple
 
 import pandas as pd
 
-from dno.proto.data import Solution, Map, Task, Results
+from dno.proto.data import Solution, Map, Task, Results, TaskBatch
 
 
 @dataclass
@@ -53,5 +53,5 @@ class BaseInteropBackend:
         while not self.session_ended:
             tasks.append(self.send_solution(Solution(ready=False)))
         result = self.results
-        frame = pd.DataFrame(data=[task.to_dict() for task in tasks[:-1]])
+        frame = TaskBatch.from_tasks(tasks[:-1]).to_frame()
         return map_data, frame, result
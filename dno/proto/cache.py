@@ -0,0 +1,49 @@
+"""
+On-disk cache of decoded maps.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Union, Optional
+
+import numpy as np
+from loguru import logger
+
+from dno.proto.data import Map
+from dno.proto.utils import get_project_root
+
+CACHE_DIR = 'data/cache'
+
+
+class MapCache:
+    """
+    Stores every decoded map as a .npy file keyed by the hash of the raw map bytes.
+    Cached maps are memory-mapped read-only, so processes loading the same map share pages.
+    """
+
+    def __init__(self, cache_dir: Optional[Union[Path, str]]=None):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else get_project_root() / CACHE_DIR
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(raw: bytes) -> str:
+        return hashlib.sha1(raw).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.npy'
+
+    def get(self, raw: bytes) -> Map:
+        """
+        Get map from the cache, decoding and storing it on a miss.
+        :param raw: Raw map packet bytes.
+        :return:    Map backed by a read-only memory map.
+        """
+        path = self.path(self.key(raw))
+        if not path.exists():
+            logger.debug(f"Map cache miss, storing map to {path}...")
+            land_map = Map.from_bytes(raw)
+            # write to a temporary file first so concurrent readers never see a partial file
+            tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npy')
+            np.save(tmp_path, land_map.data)
+            os.replace(tmp_path, path)
+        return Map(data=np.load(path, mmap_mode='r'))
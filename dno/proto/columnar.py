@@ -0,0 +1,188 @@
+"""
+Binary columnar format for recorded sessions.
+Session is stored as an uncompressed .npz file: the map as a typed array,
+one array per task field and the final score.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Union, Optional, Iterator, Tuple, Sequence, Dict, List
+
+import numpy as np
+from loguru import logger
+
+from dno.proto.data import Map, Task, Results, TaskReader, TaskBatch, TASK_COLUMNS, narrow_heights
+from dno.proto.utils import get_project_root
+
+SESSION_SUFFIX = '.npz'
+SESSION_DIR = 'data/sessions'
+MANIFEST_NAME = 'manifest.json'
+COLUMNS = TASK_COLUMNS
+
+
+def convert(task_path: Union[str, Path], output_path: Union[str, Path]) -> Path:
+    """
+    Convert length-prefixed JSON recording into the columnar format.
+    :param task_path:   Recording to convert.
+    :param output_path: Path of the session file.
+    :return:            Path of the session file.
+    """
+    land_map, tasks, score = TaskReader(task_path).read_all()
+    land_map = Map.from_dict(land_map)
+    batch = TaskBatch.from_responses(tasks)
+    columns = {column: getattr(batch, column).astype(np.int32) for column in COLUMNS}
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'wb') as file:
+        np.savez(file, map=land_map.data, score=np.float64(score['scores']), **columns)
+    logger.debug(f"Converted {task_path} to {output_path} ({len(tasks)} tasks)")
+    return output_path
+
+
+class SessionReader:
+    """
+    Reader for the columnar session files, mirrors TaskReader interface.
+    """
+
+    def __init__(self, session_path: Union[str, Path]):
+        self.session_path = Path(session_path)
+        if not self.session_path.exists():
+            raise FileNotFoundError(f"Error: can't find file \"{session_path}\"")
+        self.results: Optional[Results] = None
+
+    def read_map(self, map_cache=None) -> Map:
+        """
+        Read only the map of the task, map is already typed so cache is not used.
+        """
+        with np.load(self.session_path) as session:
+            return Map(data=narrow_heights(session['map']))
+
+    @property
+    def num_tasks(self) -> int:
+        """
+        Number of tasks, only a single column is read.
+        """
+        with np.load(self.session_path) as session:
+            return len(session['height'])
+
+    def read_batch(self) -> Tuple[TaskBatch, Results]:
+        """
+        Read all tasks as a batch along with the results, without the map.
+        """
+        with np.load(self.session_path) as session:
+            batch = TaskBatch.from_columns({column: session[column] for column in COLUMNS})
+            return batch, Results(score=float(session['score']))
+
+    def iter_responses(self) -> Iterator[dict]:
+        batch, results = self.read_batch()
+        for row in zip(*(getattr(batch, column).tolist() for column in COLUMNS)):
+            yield {"data": dict(zip(COLUMNS, row))}
+        yield {"scores": results.score}
+
+    def iter_tasks(self) -> Iterator[Task]:
+        batch, results = self.read_batch()
+        self.results = None
+        yield from batch.to_tasks()
+        self.results = results
+
+    def read_all(self, skip_map: bool=False) -> Tuple[Optional[dict], Sequence[dict], dict]:
+        land_map = None if skip_map else {"map": self.read_map().data.ravel().tolist()}
+        responses = list(self.iter_responses())
+        return land_map, responses[:-1], responses[-1]
+
+
+def open_session(path: Union[str, Path]) -> Union[TaskReader, SessionReader]:
+    """
+    Open recorded session of any supported format.
+    """
+    path = Path(path)
+    if path.suffix == SESSION_SUFFIX:
+        return SessionReader(path)
+    return TaskReader(path)
+
+
+def source_hash(task_path: Union[str, Path], chunk_size: int=1 << 20) -> str:
+    """
+    SHA1 of the recording contents.
+    """
+    digest = hashlib.sha1()
+    with open(task_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(output_dir: Union[str, Path]) -> Dict[str, str]:
+    """
+    Source hashes of the sessions converted into the output directory, by recording name.
+    """
+    manifest_path = Path(output_dir) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def _convert_task(task_path: Path, output_path: Path, digest: str) -> Tuple[str, str]:
+    convert(task_path, output_path)
+    return task_path.name, digest
+
+
+def convert_all(source_dir: Optional[Union[str, Path]]=None, output_dir: Optional[Union[str, Path]]=None,
+                jobs: Optional[int]=None, force: bool=False) -> List[Path]:
+    """
+    Convert all recordings from the source directory into session files in parallel.
+    Recordings whose hash matches the manifest of the output directory are skipped.
+    :param jobs:  Number of worker processes, defaults to the number of CPUs.
+    :param force: Convert all recordings regardless of the manifest.
+    :return:      Paths of the converted session files.
+    """
+    root = get_project_root()
+    source_dir = Path(source_dir) if source_dir is not None else root / 'data' / 'besthack19'
+    output_dir = Path(output_dir) if output_dir is not None else root / SESSION_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(output_dir)
+    outdated = []
+    for task_path in sorted(source_dir.glob('*')):
+        if not task_path.is_file():
+            continue
+        output_path = output_dir / f'{task_path.name}{SESSION_SUFFIX}'
+        digest = source_hash(task_path)
+        if not force and manifest.get(task_path.name) == digest and output_path.exists():
+            logger.debug(f"Skipping unchanged {task_path.name}")
+            continue
+        outdated.append((task_path, output_path, digest))
+    logger.info(f"Converting {len(outdated)} recordings, {len(manifest)} in the manifest")
+    converted = []
+    if outdated:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(_convert_task, *job): job[1] for job in outdated}
+            for future in as_completed(futures):
+                name, digest = future.result()
+                manifest[name] = digest
+                converted.append(futures[future])
+                logger.info(f"Converted {name}")
+        # manifest is replaced atomically so an interrupted run never marks stale sessions as fresh
+        manifest_path = output_dir / MANIFEST_NAME
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    return sorted(converted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert recorded sessions into the columnar format")
+    parser.add_argument('--source', type=Path, default=None, help="Directory with the recordings")
+    parser.add_argument('--output', type=Path, default=None, help="Directory for the session files")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--force', action='store_true', help="Convert unchanged recordings too")
+    args = parser.parse_args()
+    convert_all(args.source, args.output, jobs=args.jobs, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,26 +2,217 @@
 
 """
 import json
-from dataclasses import dataclass, asdict
+import math
+from dataclasses import dataclass, asdict, field
 from io import RawIOBase
 from pathlib import Path
-from typing import NamedTuple, Union, Tuple, Sequence, BinaryIO, IO
+from typing import NamedTuple, Union, Tuple, Sequence, BinaryIO, IO, Optional, List, Iterator, Iterable, TYPE_CHECKING
 import numpy as np
+import pandas as pd
 from loguru import logger
 
+from dno.proto.trace import TRACER
+
+if TYPE_CHECKING:
+    # the cache module imports Map from here
+    from dno.proto.cache import MapCache
+
+
+@dataclass
+class HeightIndex:
+    """
+    Map cells sorted by height, for tolerance range lookups.
+    Cells of the same height keep column-major order.
+    """
+    heights: np.ndarray
+    cells: np.ndarray
+    n_rows: int
+
+    @classmethod
+    def from_array(cls, data: np.ndarray) -> 'HeightIndex':
+        flat = data.T.ravel()
+        cells = np.argsort(flat, kind='stable')
+        return cls(heights=flat[cells], cells=cells, n_rows=data.shape[0])
+
+    def query(self, height: int, c: int, by_distance: bool=False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find all cells with height in [height - c, height + c].
+        :param by_distance: Order cells by the height difference instead of the position.
+        :return: Rows and columns of the cells in column-major order.
+        """
+        start = np.searchsorted(self.heights, height - c, side='left')
+        stop = np.searchsorted(self.heights, height + c, side='right')
+        if by_distance:
+            distance = np.abs(self.heights[start:stop] - np.float64(height))
+            cells = self.cells[start:stop][np.argsort(distance, kind='stable')]
+        else:
+            cells = np.sort(self.cells[start:stop])
+        return cells % self.n_rows, cells // self.n_rows
+
+
+@dataclass
+class HeightPyramid:
+    """
+    Min/max heights of square map tiles.
+    Level 0 holds `tile` x `tile` cell blocks, every next level merges 2x2 tiles of the previous one.
+    """
+    tile: int
+    shape: Tuple[int, int]
+    blocks: np.ndarray
+    mins: List[np.ndarray]
+    maxs: List[np.ndarray]
+
+    @classmethod
+    def from_array(cls, data: np.ndarray, tile: int=16) -> 'HeightPyramid':
+        n_rows, n_cols = data.shape
+        n_tile_rows, n_tile_cols = -(-n_rows // tile), -(-n_cols // tile)
+        # padding with the edge values keeps min/max of every tile exact
+        padded = np.pad(data, ((0, n_tile_rows * tile - n_rows), (0, n_tile_cols * tile - n_cols)), mode='edge')
+        blocks = padded.reshape(n_tile_rows, tile, n_tile_cols, tile)
+        mins, maxs = [blocks.min(axis=(1, 3))], [blocks.max(axis=(1, 3))]
+        while mins[-1].shape[0] > 1 or mins[-1].shape[1] > 1:
+            mins.append(cls._reduce(mins[-1], np.minimum))
+            maxs.append(cls._reduce(maxs[-1], np.maximum))
+        return cls(tile=tile, shape=data.shape, blocks=blocks, mins=mins, maxs=maxs)
+
+    @staticmethod
+    def _reduce(level: np.ndarray, op: np.ufunc) -> np.ndarray:
+        level = np.pad(level, ((0, level.shape[0] % 2), (0, level.shape[1] % 2)), mode='edge')
+        return op.reduce(level.reshape(level.shape[0] // 2, 2, level.shape[1] // 2, 2), axis=(1, 3))
+
+    def tile_mask(self, low: int, high: int) -> np.ndarray:
+        """
+        Level 0 tiles that may contain heights in [low, high], descending from the coarsest level.
+        """
+        passed = np.ones((1, 1), dtype=bool)
+        for mins, maxs in zip(reversed(self.mins), reversed(self.maxs)):
+            passed = np.repeat(np.repeat(passed, 2, axis=0), 2, axis=1)[:mins.shape[0], :mins.shape[1]]
+            passed &= (maxs >= low) & (mins <= high)
+        return passed
+
+    def mask(self, low: int, high: int, where: Optional[np.ndarray]=None, inclusive: bool=True) -> np.ndarray:
+        """
+        Cells with heights in [low, high], evaluated only inside the tiles that survive pruning.
+        :param where:     Optional boolean grid, tiles without any set cell are pruned as well.
+        :param inclusive: Whether the range bounds are included.
+        """
+        n_tile_rows, _, n_tile_cols, _ = self.blocks.shape
+        passed = self.tile_mask(low, high)
+        if where is not None:
+            where = self.to_blocks(where)
+            passed &= where.any(axis=(1, 3))
+        tile_rows, tile_cols = np.nonzero(passed)
+        result = np.zeros(self.blocks.shape, dtype=bool)
+        blocks = self.blocks[tile_rows, :, tile_cols, :]
+        if inclusive:
+            matched = (blocks >= low) & (blocks <= high)
+        else:
+            matched = (blocks > low) & (blocks < high)
+        if where is not None:
+            matched &= where[tile_rows, :, tile_cols, :]
+        result[tile_rows, :, tile_cols, :] = matched
+        return result.reshape(n_tile_rows * self.tile, n_tile_cols * self.tile)[:self.shape[0], :self.shape[1]]
+
+    def to_blocks(self, grid: np.ndarray) -> np.ndarray:
+        """
+        View a map-sized grid as (tile rows, tile, tile cols, tile) blocks.
+        """
+        n_tile_rows, _, n_tile_cols, _ = self.blocks.shape
+        padded = np.pad(grid, ((0, n_tile_rows * self.tile - self.shape[0]), (0, n_tile_cols * self.tile - self.shape[1])))
+        return padded.reshape(self.blocks.shape)
+
 
 @dataclass
 class Map:
     data: np.ndarray
+    _height_index: Optional[HeightIndex] = field(default=None, init=False, repr=False, compare=False)
+    _pyramid: Optional[HeightPyramid] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def height_index(self) -> HeightIndex:
+        """
+        Sorted-height index of the map, built once on the first access.
+        """
+        if self._height_index is None:
+            logger.debug(f"Building height index for map {self.data.shape}...")
+            self._height_index = HeightIndex.from_array(self.data)
+        return self._height_index
+
+    @property
+    def pyramid(self) -> HeightPyramid:
+        """
+        Min/max tile pyramid of the map, built once on the first access.
+        """
+        if self._pyramid is None:
+            logger.debug(f"Building height pyramid for map {self.data.shape}...")
+            self._pyramid = HeightPyramid.from_array(self.data)
+        return self._pyramid
 
     def region(self, x: int, y: int, size: tuple) -> np.ndarray:
         raise NotImplementedError()
 
     @classmethod
     def from_dict(cls, data: dict):
-        n: int = int(np.sqrt(len(data["map"])))
-        map_arr: np.array = np.array(data["map"]).reshape(n, n)
-        return cls(data=map_arr)
+        map_arr: np.ndarray = np.asarray(data["map"], dtype=np.int64)
+        return cls(data=narrow_heights(map_arr.reshape(square_side(len(map_arr)), -1)))
+
+    @classmethod
+    def from_bytes(cls, raw: Union[bytes, bytearray]) -> 'Map':
+        """
+        Decode raw map packet parsing the heights straight into an array, without building a list of ints.
+        :param raw: JSON of the {"map": [...]} packet.
+        """
+        key = raw.find(b'"map"')
+        start = raw.find(b'[', key)
+        stop = raw.find(b']', start)
+        if key < 0 or start < 0 or stop < 0:
+            raise ValueError(f"Not a map packet: {bytes(raw[:70])}")
+        body = bytes(raw[start + 1:stop])
+        count = body.count(b',') + 1 if body.strip() else 0
+        # parse straight into the type the longest number fits, not into int64 followed by a narrowing copy
+        map_arr = np.fromstring(body, dtype=digits_dtype(body), count=count, sep=',')
+        return cls(data=narrow_heights(map_arr.reshape(square_side(count), -1)))
+
+
+# candidate height types, signed ones only.
+# Narrow types only save memory: NumPy keeps int16 - int16 and int - int16 array results in int16,
+# so any arithmetic on map heights must cast to int64 or float64 first (np.int64(height) - heights),
+# comparisons and searchsorted with Python ints are exact for any type
+MAP_DTYPES = (np.int16, np.int32, np.int64)
+
+
+def digits_dtype(body: bytes) -> np.dtype:
+    """
+    Narrowest type of MAP_DTYPES holding any number with as many digits as the longest one of the JSON list.
+    """
+    chars = np.frombuffer(body, dtype=np.uint8)
+    separators = np.flatnonzero((chars < ord('0')) | (chars > ord('9')))
+    max_digits = int(np.diff(separators, prepend=-1, append=len(chars)).max(initial=1)) - 1
+    for dtype in MAP_DTYPES:
+        if max_digits < len(str(np.iinfo(dtype).max)):
+            return np.dtype(dtype)
+    raise ValueError(f"Map heights of {max_digits} digits don't fit {np.dtype(MAP_DTYPES[-1])}")
+
+
+def narrow_heights(data: np.ndarray) -> np.ndarray:
+    """
+    Cast heights to the narrowest type of MAP_DTYPES holding their range.
+    """
+    if data.size == 0:
+        return data
+    low, high = int(data.min()), int(data.max())
+    for dtype in MAP_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return data.astype(dtype, copy=False)
+    return data
+
+
+def square_side(size: int) -> int:
+    n = math.isqrt(size)
+    if n * n != size:
+        raise ValueError(f"Map of {size} cells is not square")
+    return n
 
 
 @dataclass
@@ -34,8 +225,8 @@ class Task:
     height: int = 0
     speed: int = 0
     psi: int = 0
-    _psi_cos: np.float = 0
-    _psi_sin: np.float = 0
+    _psi_cos: float = 0
+    _psi_sin: float = 0
 
     def __post_init__(self):
         self._psi_cos = np.cos(np.deg2rad(self.psi))
@@ -85,6 +276,88 @@ class Task:
         }
 
 
+TASK_COLUMNS = ('x', 'y', 'height', 'speed', 'psi')
+
+
+@dataclass
+class TaskBatch:
+    """
+    Struct-of-arrays counterpart of a Task list: one NumPy column per field.
+    """
+    x: np.ndarray
+    y: np.ndarray
+    height: np.ndarray
+    speed: np.ndarray
+    psi: np.ndarray
+    _psi_cos: np.ndarray = field(init=False, repr=False)
+    _psi_sin: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._psi_cos = np.cos(np.deg2rad(self.psi))
+        self._psi_sin = np.sin(np.deg2rad(self.psi))
+
+    @property
+    def vy(self) -> np.ndarray:
+        """
+        Same as Task.vy for every row.
+        """
+        return self.speed * self._psi_cos
+
+    @property
+    def vx(self) -> np.ndarray:
+        """
+        Same as Task.vx for every row.
+        """
+        return self.speed * self._psi_sin
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def __getitem__(self, item: int) -> Task:
+        return Task(**{column: getattr(self, column)[item].item() for column in TASK_COLUMNS})
+
+    @classmethod
+    def from_columns(cls, columns: dict) -> 'TaskBatch':
+        return cls(**{column: np.asarray(columns[column]) for column in TASK_COLUMNS})
+
+    @classmethod
+    def from_tasks(cls, tasks: Sequence[Task]) -> 'TaskBatch':
+        rows = np.array([[getattr(task, column) for column in TASK_COLUMNS] for task in tasks]).reshape(-1, len(TASK_COLUMNS))
+        return cls(*rows.T)
+
+    @classmethod
+    def from_responses(cls, responses: Iterable[dict]) -> 'TaskBatch':
+        """
+        Build from TaskReader responses in one pass, responses without task data are skipped.
+        """
+        try:
+            rows = [tuple(response["data"][column] for column in TASK_COLUMNS)
+                    for response in responses if "data" in response]
+        except KeyError as e:
+            raise KeyError(f"Invalid response to deserialize into task batch: {e.args[0]}")
+        return cls(*np.array(rows, dtype=np.int64).reshape(-1, len(TASK_COLUMNS)).T)
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> 'TaskBatch':
+        return cls(**{column: frame[column].to_numpy() for column in TASK_COLUMNS})
+
+    def to_tasks(self) -> List[Task]:
+        columns = [getattr(self, column).tolist() for column in TASK_COLUMNS]
+        return [Task(*row) for row in zip(*columns)]
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Frame with the same columns as Task.to_dict rows.
+        """
+        return pd.DataFrame({
+            **{column: getattr(self, column) for column in TASK_COLUMNS},
+            "_psi_cos": self._psi_cos,
+            "_psi_sin": self._psi_sin,
+            "vx": self.vx,
+            "vy": self.vy,
+        })
+
+
 class Solution(NamedTuple):
     """
     Solution to the task point.
@@ -125,6 +398,7 @@ class TaskReader:
         if not self.task_path.exists():
             raise FileNotFoundError(f"Error: can't find file \"{task_path}\"")
         self._io_wrapper: RawIOBase = None
+        self.results: Optional[Results] = None
 
     def __enter__(self):
         self._io_wrapper = open(self.task_path, 'rb')
@@ -133,9 +407,28 @@ class TaskReader:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._io_wrapper.close()
 
-    def read_all(self) -> Tuple[dict, Sequence[dict], dict]:
+    def read_map(self, map_cache: Optional['MapCache']=None) -> Map:
+        """
+        Read only the map of the task.
+        :param map_cache: Optional cache to decode the map through.
+        """
+        with self:
+            raw = self.read_next_packet(self._io_wrapper)
+        if map_cache is not None:
+            return map_cache.get(raw)
+        return Map.from_bytes(raw)
+
+    def read_all(self, skip_map: bool=False) -> Tuple[Optional[dict], Sequence[dict], dict]:
+        """
+        Read map, tasks and results.
+        :param skip_map: Seek over the map without decoding it, None is returned instead.
+        """
         with self:
-            land_map = self.read_next_response(self._io_wrapper)
+            if skip_map:
+                self._io_wrapper.seek(self.to_int(self._io_wrapper.read(4)), 1)
+                land_map = None
+            else:
+                land_map = self.read_next_response(self._io_wrapper)
             tasks = []
             while True:
                 next_size = self._io_wrapper.read(4)
@@ -145,6 +438,37 @@ class TaskReader:
 
         return land_map, tasks[:-1], tasks[-1]
 
+    def iter_responses(self) -> Iterator[dict]:
+        """
+        Lazily read responses after the map one at a time, the last one holds the results.
+        The map is skipped without decoding, read it with `read_map`.
+        """
+        with open(self.task_path, 'rb') as file:
+            file.seek(self.to_int(file.read(4)), 1)
+            while True:
+                next_size = file.read(4)
+                if len(next_size) < 4:
+                    break
+                yield self.read_next_response(file, next_size)
+
+    def read_batch(self) -> Tuple[TaskBatch, Results]:
+        """
+        Read all tasks as a batch along with the results.
+        """
+        responses = list(self.iter_responses())
+        return TaskBatch.from_responses(responses[:-1]), Results.from_dict(responses[-1])
+
+    def iter_tasks(self) -> Iterator[Task]:
+        """
+        Lazily read tasks one at a time, `results` are set once the stream is exhausted.
+        """
+        self.results = None
+        for response in self.iter_responses():
+            if "data" in response:
+                yield Task.from_dict(response["data"])
+            else:
+                self.results = Results.from_dict(response)
+
     @staticmethod
     def to_int(data: Union[bytes, str]):
         data = bytes(data)
@@ -154,20 +478,32 @@ class TaskReader:
 
     @staticmethod
     def read_next_response(file: RawIOBase, packet_size: bytes=None):
+        with TRACER.span('reader.read_next_response'):
+            data = TaskReader.read_next_packet(file, packet_size).decode()
+            logger.debug(f"Response data is ({len(data)} bytes) {data[:70]} ...")
+            return json.loads(data)
+
+    @staticmethod
+    def read_next_packet(file: RawIOBase, packet_size: bytes=None) -> bytearray:
+        """
+        Read raw bytes of the next length-prefixed packet into a preallocated buffer.
+        """
         logger.debug("Reading response...")
         size = TaskReader.to_int(packet_size or file.read(4))
         logger.debug(f"Response size is '{size}' bytes...")
-        data = b''
-        while len(data) < size:
-            to_read = size - len(data)
-            chunk = file.read(to_read)
-            data += chunk
-            if len(chunk) == 0:
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            to_read = size - received
+            chunk_size = file.readinto(view[received:])
+            if not chunk_size:
                 raise ValueError(f"Received a null-length data when expecting {to_read} bytes!")
-            logger.debug(f"[{len(data)/size*100:.2f}%] Chunk size: {len(chunk)}")
-        data = data.decode()
-        logger.debug(f"Response data is ({len(data)} bytes) {data[:70]} ...")
-        return json.loads(data)
+            received += chunk_size
+            TRACER.count('reader.chunks')
+            logger.debug(f"[{received/size*100:.2f}%] Chunk size: {chunk_size}")
+        TRACER.count('reader.bytes', size + 4)
+        return data
 
 
 if __name__ == "__main__":
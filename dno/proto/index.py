@@ -0,0 +1,213 @@
+"""
+Offset index over recordings for random access without reading them from the start.
+Sidecar index files are kept in data/index and rebuilt when the recording size or mtime changes.
+Two recording kinds are indexed:
+- packets:   length-prefixed JSON packets (data/besthack19), map first and scores last;
+- json_list: JSON list of flat objects (data/finals).
+"""
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union, Optional, List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from dno.proto.data import TaskReader, TaskBatch
+from dno.proto.utils import get_project_root
+
+INDEX_DIR = 'data/index'
+INDEX_SUFFIX = '.npz'
+PACKETS = 'packets'
+JSON_LIST = 'json_list'
+# recording directories of the catalog and the files in them
+CATALOG_SOURCES = (('besthack19', '*'), ('finals', '*.txt'))
+
+
+def _scan_packets(path: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Offsets and lengths of the packet payloads, only size prefixes are read.
+    """
+    offsets, lengths = [], []
+    size = path.stat().st_size
+    with open(path, 'rb') as file:
+        position = 0
+        while position < size:
+            header = file.read(4)
+            if len(header) < 4:
+                raise ValueError(f"Truncated packet header at {position} in {path}")
+            length = TaskReader.to_int(header)
+            offsets.append(position + 4)
+            lengths.append(length)
+            position += 4 + length
+            file.seek(position)
+    if position != size:
+        raise ValueError(f"Truncated packet at {offsets[-1]} in {path}")
+    return np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+def _scan_json_list(path: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Offsets and lengths of the list items, items are flat objects so braces are never nested.
+    """
+    data = np.fromfile(path, dtype=np.uint8)
+    starts = np.flatnonzero(data == ord('{'))
+    stops = np.flatnonzero(data == ord('}'))
+    if len(starts) != len(stops) or np.any(stops < starts) or np.any(starts[1:] < stops[:-1]):
+        raise ValueError(f"{path} is not a list of flat JSON objects")
+    return starts.astype(np.int64), (stops - starts + 1).astype(np.int64)
+
+
+@dataclass
+class RecordingIndex:
+    """
+    Byte offset and length of every record of the recording.
+    """
+    path: Path
+    kind: str
+    offsets: np.ndarray
+    lengths: np.ndarray
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def build(cls, path: Union[str, Path]) -> 'RecordingIndex':
+        path = Path(path)
+        stat = path.stat()
+        kind = JSON_LIST if path.suffix == '.txt' else PACKETS
+        offsets, lengths = _scan_packets(path) if kind == PACKETS else _scan_json_list(path)
+        return cls(path=path, kind=kind, offsets=offsets, lengths=lengths,
+                   size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    @property
+    def fresh(self) -> bool:
+        """
+        Whether the recording hasn't changed since the index was built.
+        """
+        stat = self.path.stat()
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def save(self, index_path: Union[str, Path]) -> None:
+        index_path = Path(index_path)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so concurrent readers never see a partial index
+        tmp_path = index_path.with_name(f'{index_path.stem}.{os.getpid()}.tmp{INDEX_SUFFIX}')
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, offsets=self.offsets, lengths=self.lengths, kind=self.kind,
+                     size=self.size, mtime_ns=self.mtime_ns)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], index_path: Union[str, Path]) -> 'RecordingIndex':
+        with np.load(index_path) as index:
+            return cls(path=Path(path), kind=str(index['kind']), offsets=index['offsets'], lengths=index['lengths'],
+                       size=int(index['size']), mtime_ns=int(index['mtime_ns']))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def num_tasks(self) -> int:
+        """
+        Number of tasks: records without the map and the scores for packet recordings.
+        """
+        return max(0, len(self) - 2) if self.kind == PACKETS else len(self)
+
+    def read_raw(self, start: int, stop: Optional[int]=None) -> List[bytes]:
+        """
+        Raw records [start, stop) read with a single seek.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return []
+        begin = int(self.offsets[start])
+        with open(self.path, 'rb') as file:
+            file.seek(begin)
+            chunk = file.read(int(self.offsets[stop - 1] + self.lengths[stop - 1]) - begin)
+        return [chunk[offset - begin:offset - begin + length]
+                for offset, length in zip(self.offsets[start:stop].tolist(), self.lengths[start:stop].tolist())]
+
+    def read_range(self, start: int, stop: Optional[int]=None) -> List[dict]:
+        """
+        Decoded records [start, stop), for packet recordings the map is record 0.
+        """
+        return [json.loads(raw) for raw in self.read_raw(start, stop)]
+
+    def read_tasks(self, start: int, stop: Optional[int]=None) -> TaskBatch:
+        """
+        Tasks [start, stop) of a packet recording, task 0 is the first packet after the map.
+        """
+        if self.kind != PACKETS:
+            raise ValueError(f"{self.path} has no task packets")
+        start, stop, _ = slice(start, stop).indices(self.num_tasks)
+        return TaskBatch.from_responses(self.read_range(start + 1, max(start, stop) + 1))
+
+
+def get_index_path(path: Union[str, Path], index_dir: Optional[Union[str, Path]]=None) -> Path:
+    """
+    Sidecar index path: recordings under data/ keep their relative path, others are placed by name.
+    """
+    path = Path(path).resolve()
+    root = get_project_root()
+    index_dir = Path(index_dir) if index_dir is not None else root / INDEX_DIR
+    try:
+        relative = path.relative_to(root / 'data')
+    except ValueError:
+        relative = Path(path.name)
+    return index_dir / relative.with_name(f'{relative.name}{INDEX_SUFFIX}')
+
+
+def load_index(path: Union[str, Path], index_dir: Optional[Union[str, Path]]=None) -> Optional[RecordingIndex]:
+    """
+    Load the index of the recording if it was already built and is up to date.
+    """
+    index_path = get_index_path(path, index_dir)
+    if index_path.exists():
+        index = RecordingIndex.load(path, index_path)
+        if index.fresh:
+            return index
+        logger.debug(f"Index of {path} is outdated")
+    return None
+
+
+def open_index(path: Union[str, Path], index_dir: Optional[Union[str, Path]]=None) -> RecordingIndex:
+    """
+    Load the index of the recording, building it if it is missing or outdated.
+    """
+    index = load_index(path, index_dir)
+    if index is not None:
+        return index
+    index = RecordingIndex.build(path)
+    index.save(get_index_path(path, index_dir))
+    return index
+
+
+def catalog(data_dir: Optional[Union[str, Path]]=None,
+            index_dir: Optional[Union[str, Path]]=None) -> Dict[str, RecordingIndex]:
+    """
+    Indexes of all recordings, keyed by `<directory>/<file name>`.
+    """
+    data_dir = Path(data_dir) if data_dir is not None else get_project_root() / 'data'
+    indexes = {}
+    for directory, pattern in CATALOG_SOURCES:
+        for path in sorted((data_dir / directory).glob(pattern)):
+            if path.is_file():
+                indexes[f'{directory}/{path.name}'] = open_index(path, index_dir)
+    return indexes
+
+
+def catalog_frame(data_dir: Optional[Union[str, Path]]=None,
+                  index_dir: Optional[Union[str, Path]]=None) -> pd.DataFrame:
+    """
+    Catalog summary: one row per recording.
+    """
+    rows = [{"name": name, "kind": index.kind, "records": len(index), "tasks": index.num_tasks,
+             "bytes": index.size, "path": str(index.path)}
+            for name, index in catalog(data_dir, index_dir).items()]
+    return pd.DataFrame(rows, columns=["name", "kind", "records", "tasks", "bytes", "path"])
+
+
+if __name__ == "__main__":
+    print(catalog_frame().to_string(index=False))
@@ -1,9 +1,12 @@
 from pathlib import Path
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Iterator
 from loguru import logger
 
-from dno.proto.data import Map, Solution, Task, Results, TaskReader
+from dno.proto.data import Map, Solution, Task, Results
 from dno.proto.base import BaseInteropBackend
+from dno.proto.cache import MapCache
+from dno.proto.columnar import open_session, SessionReader
+from dno.proto.index import load_index, RecordingIndex
 
 
 class MockInterop(BaseInteropBackend):
@@ -16,16 +19,19 @@ class MockInterop(BaseInteropBackend):
         """
         True when session has ended.
         """
-        return len(self._solutions) >= len(self._tasks)
+        return self._actual_score is not None
 
     @property
     def current_iteration(self) -> int:
         return len(self._solutions)
 
-    def __init__(self, base_dir: Union[Path, str]):
+    def __init__(self, base_dir: Union[Path, str], map_cache: Optional[MapCache]=None):
         self.base_dir = Path(base_dir)
+        self.map_cache = map_cache
 
-        self._map, self._tasks, self._score = None, None, None
+        self._map, self._tasks = None, None
+        self._num_tasks: int = 0
+        self._responses: Iterator[dict] = None
         self._task = None
         self._solutions: List[dict] = []
         self._actual_score: Results = None
@@ -46,6 +52,13 @@ class MockInterop(BaseInteropBackend):
         """
         Get number of tasks in the mock.
         """
+        return self._num_tasks
+
+    @property
+    def num_tasks_read(self) -> int:
+        """
+        Get number of tasks read from the recording so far.
+        """
         return len(self._tasks)
 
     def start_task(self, task_name: str) -> Map:
@@ -54,12 +67,22 @@ class MockInterop(BaseInteropBackend):
         :return: Map instance.
         """
         logger.debug(f"Starting mock backend interaction {task_name}")
-        reader = TaskReader(self.base_dir / task_name)
+        reader = open_session(self.base_dir / task_name)
         self._solutions = []
         self._task = task_name
         self._actual_score = None
-        self._map, self._tasks, self._score = reader.read_all()
-        return Map.from_dict(self._map)
+        self._map = reader.read_map(self.map_cache)
+        # total is known without reading the tasks: from a single column or the packet size prefixes,
+        # an already built offset index is reused but never written from here
+        if isinstance(reader, SessionReader):
+            self._num_tasks = reader.num_tasks
+        else:
+            index = load_index(reader.task_path)
+            self._num_tasks = (index or RecordingIndex.build(reader.task_path)).num_tasks
+        # responses are read lazily, the first task is consumed along with the map
+        self._responses = reader.iter_responses()
+        self._tasks = [next(self._responses)]
+        return self._map
 
     def send_solution(self, solution: Solution) -> Union[Task, Results]:
         """
@@ -70,8 +93,10 @@ class MockInterop(BaseInteropBackend):
         if self.session_ended:
             raise RuntimeError("You should stahp!")
         self._solutions.append(solution.to_dict())
-        if self.session_ended:  # last iteration
-            self._actual_score = Results.from_dict(self._score)
+        response = next(self._responses)
+        if "data" not in response:  # last iteration
+            self._actual_score = Results.from_dict(response)
             return self._actual_score
         else:
-            return Task.from_dict(self._tasks[len(self._solutions)]['data'])
+            self._tasks.append(response)
+            return Task.from_dict(response['data'])
@@ -0,0 +1,147 @@
+"""
+Local stand-in for the backend: serves recorded sessions over the same
+4-byte little-endian length-prefixed JSON protocol and scores submitted solutions.
+"""
+import asyncio
+import json
+import random
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Union, Optional, Dict, List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from dno.model import scoring
+from dno.proto.backend import BackendInteraction
+from dno.proto.columnar import open_session, SESSION_SUFFIX
+from dno.proto.data import Solution
+from dno.proto.utils import get_project_root
+
+
+class ReplayServer:
+    """
+    TCP server replaying recordings from `data_dir` (`task{N}` or `task{N}.npz` files).
+    Every response is delayed by `latency` +- `jitter` seconds.
+    """
+
+    def __init__(self, data_dir: Optional[Union[str, Path]]=None, host: str='127.0.0.1', port: int=4242,
+                 latency: float=0., jitter: float=0., seed: Optional[int]=None):
+        self.data_dir = Path(data_dir) if data_dir is not None else get_project_root() / 'data' / 'besthack19'
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._sessions: Dict[int, Tuple[bytes, List[dict], int]] = {}
+        self._server: asyncio.AbstractServer = None
+
+    def _load(self, task_index: int) -> Tuple[bytes, List[dict], int]:
+        """
+        Encoded map packet, task data and map size of the recording, loaded once per task.
+        """
+        if task_index not in self._sessions:
+            path = self.data_dir / f'task{task_index}'
+            if not path.exists():
+                path = path.with_name(f'{path.name}{SESSION_SUFFIX}')
+            reader = open_session(path)
+            land_map = reader.read_map()
+            map_packet = BackendInteraction.prepare_data({"map": land_map.data.ravel().tolist()})
+            tasks = [response["data"] for response in reader.iter_responses() if "data" in response]
+            self._sessions[task_index] = map_packet, tasks, land_map.data.size
+        return self._sessions[task_index]
+
+    async def _delay(self) -> None:
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info('peername')
+
+        async def receive() -> dict:
+            size = int.from_bytes(await reader.readexactly(4), byteorder="little")
+            return json.loads(await reader.readexactly(size))
+
+        async def send(packet: bytes) -> None:
+            await self._delay()
+            writer.write(packet)
+            await writer.drain()
+
+        try:
+            start = await receive()
+            try:
+                # the first load of a recording reads and encodes it, so it is kept off the event loop
+                map_packet, tasks, map_size = await asyncio.get_running_loop().run_in_executor(
+                    None, self._load, int(start["task"]))
+            except (KeyError, ValueError, FileNotFoundError) as e:
+                await send(BackendInteraction.prepare_data({"error": f"Invalid start message {start}: {e!r}"}))
+                return
+            logger.info(f"[{peer}] Replaying task {start['task']} ({len(tasks)} tasks)")
+            await send(map_packet)
+            # the first solution is sent before any task is received
+            await receive()
+            solutions = []
+            for task in tasks:
+                await send(BackendInteraction.prepare_data({"data": task}))
+                solutions.append(await receive())
+            errors = scoring.answer_errors(solutions, tasks, map_size)
+            await send(BackendInteraction.prepare_data({"scores": scoring.mse(errors)}))
+        except asyncio.IncompleteReadError:
+            logger.warning(f"[{peer}] Client disconnected")
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Replay server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self) -> 'ReplayServer':
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+
+def measure_round_trips(task_index: int, host: str='127.0.0.1', port: int=4242) -> np.ndarray:
+    """
+    Replay a task through the blocking BackendInteraction sending empty solutions.
+    :return: Round-trip time of every step in seconds.
+    """
+    backend = BackendInteraction(backend_host=host, backed_port=port, auth="replay")
+    backend.start_task(task_index)
+    latencies = []
+    while not backend.session_ended:
+        start = time.perf_counter()
+        backend.send_solution(Solution(ready=False))
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default=None, help="directory with recorded sessions")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=4242)
+    parser.add_argument("--latency", type=float, default=0., help="response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0., help="response delay jitter in seconds")
+    args = parser.parse_args()
+    server = ReplayServer(data_dir=args.data_dir, host=args.host, port=args.port,
+                          latency=args.latency, jitter=args.jitter)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Opt-in instrumentation: timed spans and counters on the hot paths,
+exported as Chrome trace JSON (chrome://tracing, Perfetto) or a CSV timeline.
+Every event is tagged with the session it belongs to, so concurrent sessions can be told apart.
+Disabled tracer costs an attribute check per instrumented call, spans return a shared no-op context.
+"""
+import contextvars
+import csv
+import json
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import wraps, partial
+from pathlib import Path
+from time import perf_counter
+from typing import Union, List, Dict, Callable, Optional, Any
+
+from loguru import logger
+
+
+# session of the running code, asyncio tasks get their own copy of the context
+_SESSION: contextvars.ContextVar = contextvars.ContextVar('trace_session', default=None)
+_NO_SPAN = nullcontext()
+
+
+def bind_session(func: Callable, *args) -> Callable[[], Any]:
+    """
+    Bind the call to the current session, executors don't pass the context to their threads.
+    """
+    return partial(contextvars.copy_context().run, func, *args)
+
+
+class Tracer:
+    """
+    Collects spans and counters of the sessions.
+    """
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.events: List[dict] = []
+        # counters of every session
+        self.counters: Dict[Optional[str], Dict[str, float]] = {}
+        self._origin = perf_counter()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self.events = []
+        self.counters = {}
+        self._origin = perf_counter()
+
+    @contextmanager
+    def session(self, session_id: str):
+        """
+        Tag events of the enclosed block with the session id.
+        """
+        token = _SESSION.set(session_id)
+        try:
+            yield
+        finally:
+            _SESSION.reset(token)
+
+    def _timestamp(self) -> float:
+        """
+        Microseconds since the tracer origin.
+        """
+        return (perf_counter() - self._origin) * 1e6
+
+    def span(self, name: str, **args):
+        """
+        Time the enclosed block.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name: str, args: dict):
+        start = self._timestamp()
+        try:
+            yield
+        finally:
+            self.events.append({"name": name, "ph": "X", "ts": start, "dur": self._timestamp() - start,
+                                "pid": os.getpid(), "tid": threading.get_ident(), "session": _SESSION.get(),
+                                "args": args})
+
+    def count(self, name: str, value: float=1) -> None:
+        """
+        Increase cumulative counter.
+        """
+        if self.enabled:
+            self.gauge(name, self.counters.get(_SESSION.get(), {}).get(name, 0) + value)
+
+    def gauge(self, name: str, value: float) -> None:
+        """
+        Record current value of a counter.
+        """
+        if self.enabled:
+            session = _SESSION.get()
+            self.counters.setdefault(session, {})[name] = value
+            self.events.append({"name": name, "ph": "C", "ts": self._timestamp(),
+                                "pid": os.getpid(), "tid": threading.get_ident(), "session": session,
+                                "args": {name: value}})
+
+    def export(self, path: Union[str, Path], session: Optional[str]=None) -> None:
+        """
+        Write the trace, CSV timeline for .csv paths and Chrome trace JSON otherwise.
+        :param session: Export only the events of the session.
+        """
+        path = Path(path)
+        events = self.events if session is None else [event for event in self.events if event["session"] == session]
+        if path.suffix == '.csv':
+            with open(path, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['session', 'name', 'type', 'start_ms', 'duration_ms', 'args'])
+                for event in events:
+                    writer.writerow([event["session"], event["name"], 'span' if event["ph"] == 'X' else 'counter',
+                                     event["ts"] / 1000, event.get("dur", 0) / 1000, json.dumps(event["args"])])
+        else:
+            with open(path, 'w') as file:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        logger.info(f"Trace with {len(events)} events written to {path}")
+
+
+TRACER = Tracer()
+
+
+def traced(name: str) -> Callable:
+    """
+    Decorator timing every call of the function with the global tracer.
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with TRACER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
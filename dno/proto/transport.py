@@ -0,0 +1,91 @@
+"""
+Persistent connection to the backend speaking the 4-byte little-endian length-prefixed JSON protocol.
+"""
+import json
+import socket
+from typing import Optional, Union
+
+from loguru import logger
+
+from dno.proto.data import Solution, TaskReader
+
+# TCP keepalive: first probe after KEEPALIVE_IDLE seconds of silence, then every KEEPALIVE_INTERVAL seconds
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+READ_BUFFER_SIZE = 1 << 16
+
+
+class Transport:
+    """
+    Single long-lived socket with a buffered reader and a reusable outgoing buffer.
+    Nagle's algorithm is disabled, since every request is a small packet waiting for the answer.
+    """
+
+    def __init__(self, host: str, port: int, timeout: Optional[float]=None, keepalive: bool=True):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._socket: Optional[socket.socket] = None
+        self._reader = None
+        # size prefix followed by the payload, reused between messages
+        self._buffer = bytearray(4)
+
+    @property
+    def connected(self) -> bool:
+        return self._socket is not None
+
+    def connect(self) -> None:
+        logger.info(f"Connecting to {self.host}:{self.port}...")
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # fine-grained keepalive options are not available on every platform
+            for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                                  ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        self._socket = sock
+        self._reader = sock.makefile('rb', buffering=READ_BUFFER_SIZE)
+
+    def close(self) -> None:
+        if self._socket is None:
+            return
+        self._reader.close()
+        self._socket.close()
+        self._socket = None
+        self._reader = None
+
+    def reconnect(self) -> None:
+        self.close()
+        self.connect()
+
+    @staticmethod
+    def encode_solution(solution: Solution) -> bytes:
+        """
+        Serialize solution exactly like `json.dumps(solution.to_dict())` without going through json.
+        """
+        data = solution.to_dict()
+        return b'{"x": %d, "y": %d, "ready": %d}' % (data["x"], data["y"], data["ready"])
+
+    def send(self, data: Union[dict, bytes]) -> None:
+        """
+        Send a message: dictionary to encode or an already encoded JSON payload.
+        """
+        payload = data if isinstance(data, bytes) else json.dumps(data).encode()
+        buffer = self._buffer
+        del buffer[4:]
+        buffer[:4] = len(payload).to_bytes(4, byteorder="little")
+        buffer += payload
+        self._socket.sendall(buffer)
+
+    def receive(self) -> bytearray:
+        """
+        Raw JSON payload of the next message.
+        """
+        packet_size = self._reader.read(4)
+        if len(packet_size) < 4:
+            raise ConnectionError(f"Connection to {self.host}:{self.port} closed by the peer")
+        return TaskReader.read_next_packet(self._reader, packet_size)
@@ -2,6 +2,7 @@ from pathlib import Path
 from typing import Optional
 
 TASK_PATH_TEMPLATE = 'data/besthack19/task{}'
+SESSION_PATH_TEMPLATE = 'data/sessions/task{}.npz'
 
 
 def get_project_root()-> Optional[Path]:
@@ -20,3 +21,13 @@ def get_task_path(task_number: int) -> Path:
     if not result.exists():
         raise FileNotFoundError()
     return result
+
+
+def get_session_path(task_number: int) -> Path:
+    """
+    Columnar session file of the task if it was converted, raw recording otherwise.
+    """
+    result = get_project_root() / SESSION_PATH_TEMPLATE.format(task_number)
+    if result.exists():
+        return result
+    return get_task_path(task_number)
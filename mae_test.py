@@ -2,20 +2,12 @@ import json
 from typing import List
 from loguru import logger
 
+from dno.model import scoring
 from dno.proto.utils import get_project_root
 
 
 def mse(answers: List[dict], correct: List[dict], map_size: int):
-    mse = 0
-    for answer, correct in zip(answers, correct):
-        if not answer['ready']:
-            mse += 0.5
-        else:
-            err = (answer['x'] - correct['x']) ** 2 + (answer['y'] - correct['y']) ** 2
-            err /= map_size**2
-            mse += err
-    mse /= len(answers)
-    return mse
+    return scoring.mse(scoring.answer_errors(answers, correct, map_cells=map_size ** 2))
 
 
 if __name__ == "__main__":
@@ -26,4 +18,4 @@ if __name__ == "__main__":
     image_size = 1081
     error = mse(answer_data, correct_data, map_size=1081)
     logger.success(f"MSE: {error}")
-    logger.success(f"SCORE: {1000*(1-error):.0f}")
+    logger.success(f"SCORE: {scoring.score(error):.0f}")
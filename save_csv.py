@@ -1,6 +1,6 @@
 from typing import List, Union
 from pathlib import Path
-from dno.proto.mock import MockInterop, BaseInteropBackend
+from dno.proto.mock import MockInterop
 from dno.proto.utils import get_project_root
 from loguru import logger
 
@@ -10,7 +10,7 @@ def get_csvs(tasks: List[str]=None, output_dir: Union[Path, str]="data/csvs"):
     Get csv data
     """
     root: Path = get_project_root() / "data" / "besthack19"
-    output_dir = get_project_root() / 'data'/ 'csvs'
+    output_dir = get_project_root() / output_dir
     if tasks is None:
         tasks = root.glob('*')
         tasks = [path.name for path in tasks if path.is_file()]
@@ -20,8 +20,8 @@ def get_csvs(tasks: List[str]=None, output_dir: Union[Path, str]="data/csvs"):
 
     for task in tasks:
         logger.info(f"Saving info for {task}...")
-        backend = MockInterop(root, task)
-        _, df, _ = backend.get_csv()
+        backend = MockInterop(root)
+        _, df, _ = backend.get_csv(task)
         df.to_csv(str(output_dir / f'{task}.csv'))
 
 